@@ -133,10 +133,11 @@ def upload_dem(id, dem_path):
         headers = {'Content-type': 'image/tiff', }
         user = geoserver['user']
         password = geoserver['password']
-        data = open(file_path, 'rb').read()
 
         request_url = '{0}workspaces/{1}/coveragestores/{2}/file.geotiff'.format(geoserver['rest_url'],
                                                                                  WORKSPACE, storename)
 
-        requests.put(request_url, verify=False, headers=headers, data=data, auth=(user, password))
+        # stream the DEM from disk rather than reading it into memory
+        with open(file_path, 'rb') as data:
+            requests.put(request_url, verify=False, headers=headers, data=data, auth=(user, password))
     os.remove(os.path.join(data_path, 'temp', 'DEMfiles', id))
\ No newline at end of file
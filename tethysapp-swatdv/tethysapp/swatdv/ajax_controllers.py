@@ -1,11 +1,11 @@
 import os, json
 from .model import *
-from django.http import JsonResponse, HttpResponseRedirect, HttpResponse
+from django.http import JsonResponse, HttpResponseRedirect, HttpResponse, StreamingHttpResponse
 from django.core.files import File
-from sqlalchemy.sql import text
-from .app import swatdv
 from .config import *
+from .database import track_queries
 
+@track_queries
 def get_upstream(request):
     """
     Controller to get list of all upstream reach ids and pass it to front end
@@ -24,34 +24,64 @@ def get_upstream(request):
     json_dict = JsonResponse({'watershed': watershed, 'streamID': streamID, 'upstreams': upstreams})
     return json_dict
 
-def save_json(request):
+@track_queries
+def upstream_geometry(request):
     """
-    Controller to save upstream stream and subbasin json files to user's data cart
+    Controller for the dissolved upstream subbasins or reaches of an outlet as GeoJSON for the map; the individual
+    subbasins or reaches are saved to the user's data cart
     """
-    upstream_json = json.loads(request.body)
-    bbox = upstream_json['bbox']
-    srs = 'EPSG:'
-    srs += upstream_json['crs']['properties']['name'].split(':')[-1]
-    unique_id = upstream_json['uniqueId']
-    outletID = upstream_json['outletID']
-    feature_type = upstream_json['featureType']
-
-    unique_path = os.path.join(temp_workspace, unique_id)
-    with open(unique_path + '/' + feature_type + '_upstream_' + outletID + '.json', 'w') as outfile:
-        json.dump(upstream_json, outfile)
+    watershed = request.POST.get('watershed')
+    watershed_id = request.POST.get('watershed_id')
+    streamID = request.POST.get('streamID')
+    unique_id = request.POST.get('id')
+    feature_type = request.POST.get('featureType')
 
-    json_dict = JsonResponse({'id': unique_id, 'bbox': bbox, 'srs': srs})
-    return json_dict
+    save_upstream_geojson(watershed, watershed_id, unique_id, streamID, feature_type)
+    geojson = upstream_geojson(watershed, watershed_id, streamID, feature_type)
+    return HttpResponse(geojson, content_type='application/json')
 
 def clip_rasters(request):
+    """
+    Controller that starts clipping a raster in the background and returns the job id to poll
+    """
     watershed = request.POST.get('watershed')
+    watershed_id = request.POST.get('watershed_id')
     userId = request.POST.get('userId')
     outletID = request.POST.get('outletID')
     raster_type = request.POST.get('raster_type')
-    clip_raster(watershed, userId, outletID, raster_type)
-    json_dict = JsonResponse({'watershed': watershed, 'raster_type': raster_type})
+    job_id = submit_clip(watershed, watershed_id, userId, outletID, raster_type)
+    json_dict = JsonResponse({'watershed': watershed, 'raster_type': raster_type, 'job_id': job_id})
     return(json_dict)
 
+def clip_status(request):
+    """
+    Controller for the status, progress and resulting layer name of a clip job
+    """
+    status = clip_queue.status(request.GET.get('job_id'))
+    if status is None:
+        return JsonResponse({'status': 'unknown'}, status=404)
+    return JsonResponse(status)
+
+def clip_tile(request):
+    """
+    Controller for PNG XYZ tiles of a clipped lulc or soil raster
+    """
+    watershed_id = request.GET.get('watershed_id')
+    clip = request.GET.get('clip')
+    raster_type = request.GET.get('raster_type')
+    color = request.GET.get('color', 'class')
+    try:
+        z, x, y = int(request.GET.get('z')), int(request.GET.get('x')), int(request.GET.get('y'))
+        png = render_tile(watershed_id, clip, raster_type, color, z, x, y)
+    except (TypeError, ValueError) as e:
+        return HttpResponse(str(e), status=400, content_type='text/plain')
+    if png is None:
+        return HttpResponse('clip not found', status=404, content_type='text/plain')
+    response = HttpResponse(png, content_type='image/png')
+    response['Cache-Control'] = 'private, max-age={0}'.format(clip_tiles['max_age'])
+    return response
+
+@track_queries
 def timeseries(request):
     """
     Controller for the time-series plot.
@@ -65,21 +95,106 @@ def timeseries(request):
     streamID = request.POST.get('streamID')
     monthOrDay = request.POST.get('monthOrDay')
     file_type = request.POST.get('fileType')
+    stat = request.POST.get('stat')
+    max_points = request.POST.get('max_points')
+    max_points = int(max_points) if max_points else None
+    if stat and stat not in rollup_stat_columns:
+        return JsonResponse({'error': 'unknown stat ' + stat}, status=400)
+
+    if 'application/octet-stream' in request.META.get('HTTP_ACCEPT', ''):
+        # compact binary format (see pack_timeseries) for clients that ask for it
+        return HttpResponse(extract_binary(file_type, monthOrDay, watershed, watershed_id, start, end, parameters,
+                                           streamID, stat), content_type='application/octet-stream')
 
-    if file_type == 'rch':
-        # Call the correct rch data parser function based on whether the monthly or daily toggle was selected
-        if monthOrDay == 'Monthly':
-            print({'Error': 'No monthly data available currently'})
-            # timeseries_dict = extract_monthly_rch(watershed, start, end, parameters, streamID)
-        else:
-            timeseries_dict = extract_daily_rch(watershed, watershed_id, start, end, parameters, streamID)
+    if monthOrDay in rollup_periods:
+        # Monthly and annual values come from the rollup tables filled at upload
+        timeseries_dict = extract_rollup(file_type, monthOrDay, watershed, watershed_id, start, end, parameters,
+                                         streamID, stat)
+    elif file_type == 'rch':
+        timeseries_dict = extract_daily_rch(watershed, watershed_id, start, end, parameters, streamID, max_points)
     elif file_type == 'sub':
-        timeseries_dict = extract_sub(watershed, watershed_id, start, end, parameters, streamID)
+        timeseries_dict = extract_sub(watershed, watershed_id, start, end, parameters, streamID, max_points)
 
     # Return the json object back to main.js for timeseries plotting
     json_dict = JsonResponse(timeseries_dict)
     return json_dict
 
+@track_queries
+def timeseries_batch(request):
+    """
+    Controller for the timeseries of many reaches or subbasins at once (e.g. everything returned by get_upstream)
+    """
+    watershed_id = int(request.POST.get('watershed_id'))
+    watershed = request.POST.get('watershed')
+    start = request.POST.get('startDate')
+    end = request.POST.get('endDate')
+    parameters = request.POST.getlist('parameters[]')
+    streamIDs = request.POST.getlist('streamIDs[]')
+    file_type = request.POST.get('fileType')
+
+    if 'application/octet-stream' in request.META.get('HTTP_ACCEPT', ''):
+        return HttpResponse(extract_batch_binary(file_type, watershed, watershed_id, start, end, parameters, streamIDs),
+                            content_type='application/octet-stream')
+
+    json_dict = JsonResponse(extract_batch(file_type, watershed, watershed_id, start, end, parameters, streamIDs))
+    return json_dict
+
+@track_queries
+def upstream_timeseries(request):
+    """
+    Controller for output.sub variables accumulated over all subbasins draining to one or more outlets
+    """
+    watershed_id = int(request.POST.get('watershed_id'))
+    watershed = request.POST.get('watershed')
+    start = request.POST.get('startDate')
+    end = request.POST.get('endDate')
+    parameters = request.POST.getlist('parameters[]')
+    outlets = request.POST.getlist('streamIDs[]')
+
+    try:
+        if 'application/octet-stream' in request.META.get('HTTP_ACCEPT', ''):
+            return HttpResponse(extract_upstream_binary(watershed, watershed_id, start, end, parameters, outlets),
+                                content_type='application/octet-stream')
+        upstream_dict = extract_upstream(watershed, watershed_id, start, end, parameters, outlets)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    json_dict = JsonResponse(upstream_dict)
+    return json_dict
+
+@track_queries
+def flow_path(request):
+    """
+    Controller for the reaches downstream of a reach to its outlet, or on the flow path between two reaches
+    """
+    watershed_id = request.POST.get('watershed_id')
+    streamID = request.POST.get('streamID')
+    toID = request.POST.get('toID')
+
+    if toID:
+        path = get_path(watershed_id, streamID, toID)
+    else:
+        path = get_downstreams(watershed_id, streamID)
+
+    json_dict = JsonResponse({'streamID': streamID, 'toID': toID, 'path': path})
+    return json_dict
+
+@track_queries
+def longitudinal_profile(request):
+    """
+    Controller for a variable's values on one date along the main stem upstream of a reach
+    """
+    watershed_id = int(request.POST.get('watershed_id'))
+    watershed = request.POST.get('watershed')
+    streamID = request.POST.get('streamID')
+    parameter = request.POST.get('parameter')
+    date = request.POST.get('date')
+    file_type = request.POST.get('fileType', 'rch')
+
+    json_dict = JsonResponse(extract_profile(file_type, watershed, watershed_id, streamID, parameter, date))
+    return json_dict
+
+@track_queries
 def coverage_compute(request):
     """
     Controller for computing the lulc or soil coverage statistics
@@ -89,8 +204,12 @@ def coverage_compute(request):
     watershed = request.POST.get('watershed')
     watershed_id = request.POST.get('watershed_id')
     raster_type = request.POST.get('raster_type')
-    # clip_raster(watershed, uniqueID, outletID, raster_type)
     coverage_dict = coverage_stats(watershed, watershed_id, uniqueID, outletID, raster_type)
+    if coverage_dict is None:
+        # no histograms for this watershed and no clip to count yet: clip in the background and let the page ask
+        # again once the job is done
+        job_id = submit_clip(watershed, watershed_id, uniqueID, outletID, raster_type)
+        return JsonResponse({'status': 'pending', 'job_id': job_id}, status=202)
     json_dict = JsonResponse(coverage_dict)
     return(json_dict)
 
@@ -113,10 +232,34 @@ def run_nasaaccess(request):
 
 def save_file(request):
     data_json = json.loads(request.body)
+    # the csv is always written at full resolution from the series store, even if the plot was downsampled
     file_dict = write_csv(data_json)
     json_dict = JsonResponse(file_dict)
     return json_dict
 
+def export_csv(request):
+    """
+    Controller to stream a timeseries as a csv download straight from the series store
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    watershed_id = int(params.get('watershed_id'))
+    watershed = params.get('watershed')
+    start = params.get('startDate')
+    end = params.get('endDate')
+    parameters = params.getlist('parameters[]')
+    streamID = params.get('streamID')
+    timestep = params.get('monthOrDay', 'Daily')
+    file_type = params.get('fileType')
+    stat = params.get('stat')
+    if stat and stat not in rollup_stat_columns:
+        return JsonResponse({'error': 'unknown stat ' + stat}, status=400)
+
+    file_name = csv_file_info(watershed, file_type, timestep, start, end, parameters, streamID)[0]
+    response = StreamingHttpResponse(csv_rows(file_type, timestep, watershed, watershed_id, start, end, parameters,
+                                              streamID, stat), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=' + file_name + '.csv'
+    return response
+
 def download_files(request):
     if request.method == 'POST':
         uniqueID = request.POST['userID']
@@ -133,14 +276,12 @@ def download_files(request):
         response['Content-Disposition'] = 'attachment; filename=' + uniqueID + '.zip'
         return response
 
+@track_queries
 def update_selectors(request):
     watershed_id = request.POST.get('watershed_id')
     selector_dict = {'rch':{}, 'sub':{}, 'lulc':{}, 'soil':{}, 'stations':{}, 'nasaaccess':{}}
-    Session = swatdv.get_persistent_store_database(db['name'], as_sessionmaker=True)
-    session = Session()
-
-    infqr = """SELECT sub,rch,lulc,soil,stations,nasaaccess FROM watershed_info WHERE watershed_id={0}""".format(watershed_id)
-    infex = session.execute(text(infqr)).fetchall()
+    # everything the selectors need comes from one row of watershed_info
+    infex = fetch('watershed_info', watershed_id)
 
     sub_avail = infex[0][0]
     rch_avail = infex[0][1]
@@ -157,17 +298,12 @@ def update_selectors(request):
 
 
     if rch_avail == 'Yes':
-        dqrch = """SELECT rch_start,rch_end FROM watershed_info WHERE watershed_id={0}""".format(
-            watershed_id)
-        rchdex = session.execute(text(dqrch)).fetchall()
-        rch_start = rchdex[0][0].strftime("%b %d, %Y")
+        rch_start = infex[0][6].strftime("%b %d, %Y")
         selector_dict['rch']['start'] = rch_start
-        rch_end = rchdex[0][1].strftime("%b %d, %Y")
+        rch_end = infex[0][7].strftime("%b %d, %Y")
         selector_dict['rch']['end'] = rch_end
 
-        vqrch = """SELECT rch_vars FROM watershed_info WHERE watershed_id={0}""".format(watershed_id)
-        rchvex = session.execute(text(vqrch)).fetchall()
-        rchvex = rchvex[0][0].split(',')
+        rchvex = infex[0][8].split(',')
         rch_options = []
         for var in rchvex:
             option = (rch_param_names[var], var)
@@ -175,23 +311,27 @@ def update_selectors(request):
         selector_dict['rch']['vars'] = rch_options
 
     if sub_avail == 'Yes':
-        dqsub = """SELECT sub_start,sub_end FROM watershed_info WHERE watershed_id={0}""".format(
-            watershed_id)
-        subdex = session.execute(text(dqsub)).fetchall()
-        sub_start = subdex[0][0].strftime("%b %d, %Y")
+        sub_start = infex[0][9].strftime("%b %d, %Y")
         selector_dict['sub']['start'] = sub_start
-        sub_end = subdex[0][1].strftime("%b %d, %Y")
+        sub_end = infex[0][10].strftime("%b %d, %Y")
         selector_dict['sub']['end'] = sub_end
 
-        vqsub = """SELECT sub_vars FROM watershed_info WHERE watershed_id={0}""".format(watershed_id)
-        subvex = session.execute(text(vqsub)).fetchall()
-        subvex = subvex[0][0].split(',')
+        subvex = infex[0][11].split(',')
         sub_options = []
         for var in subvex:
             option = (sub_param_names[str(var)], str(var))
             sub_options.append(option)
         selector_dict['sub']['vars'] = sub_options
 
-    session.close()
     json_dict = JsonResponse(selector_dict)
-    return json_dict
\ No newline at end of file
+    return json_dict
+
+def cache_stats(request):
+    """
+    Controller to report the size and hit/miss counters of the timeseries cache, the shared clip cache and the tile
+    cache
+    """
+    stats = timeseries_cache.stats()
+    stats['clips'] = clip_files.stats()
+    stats['tiles'] = tile_cache.stats()
+    return JsonResponse(stats)
@@ -40,20 +40,50 @@ class swatdv(TethysAppBase):
                 controller='swatdv.ajax_controllers.get_upstream'
             ),
             UrlMap(
-                name='save_json',
-                url='swatdv/save_json',
-                controller='swatdv.ajax_controllers.save_json'
+                name='upstream_geometry',
+                url='swatdv/upstream_geometry',
+                controller='swatdv.ajax_controllers.upstream_geometry'
             ),
             UrlMap(
                 name='timeseries',
                 url='swatdv/timeseries',
                 controller='swatdv.ajax_controllers.timeseries'
             ),
+            UrlMap(
+                name='timeseries_batch',
+                url='swatdv/timeseries_batch',
+                controller='swatdv.ajax_controllers.timeseries_batch'
+            ),
             UrlMap(
                 name='clip_rasters',
                 url='swatdv/clip_rasters',
                 controller='swatdv.ajax_controllers.clip_rasters'
             ),
+            UrlMap(
+                name='clip_status',
+                url='swatdv/clip_status',
+                controller='swatdv.ajax_controllers.clip_status'
+            ),
+            UrlMap(
+                name='clip_tile',
+                url='swatdv/clip_tile',
+                controller='swatdv.ajax_controllers.clip_tile'
+            ),
+            UrlMap(
+                name='upstream_timeseries',
+                url='swatdv/upstream_timeseries',
+                controller='swatdv.ajax_controllers.upstream_timeseries'
+            ),
+            UrlMap(
+                name='flow_path',
+                url='swatdv/flow_path',
+                controller='swatdv.ajax_controllers.flow_path'
+            ),
+            UrlMap(
+                name='longitudinal_profile',
+                url='swatdv/longitudinal_profile',
+                controller='swatdv.ajax_controllers.longitudinal_profile'
+            ),
             UrlMap(
                 name='coverage_compute',
                 url='swatdv/coverage_compute',
@@ -69,11 +99,21 @@ class swatdv(TethysAppBase):
                 url='swatdv/save_file',
                 controller='swatdv.ajax_controllers.save_file'
             ),
+            UrlMap(
+                name='export_csv',
+                url='swatdv/export_csv',
+                controller='swatdv.ajax_controllers.export_csv'
+            ),
             UrlMap(
                 name='download_files',
                 url='swatdv/download_files',
                 controller='swatdv.ajax_controllers.download_files'
             ),
+            UrlMap(
+                name='cache_stats',
+                url='swatdv/cache_stats',
+                controller='swatdv.ajax_controllers.cache_stats'
+            ),
         )
 
         return url_maps
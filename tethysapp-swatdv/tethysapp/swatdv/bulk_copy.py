@@ -0,0 +1,64 @@
+from collections import deque
+
+# bytes copy_expert asks for per read
+copy_buffer_size = 1024 * 1024
+
+
+class CopyStream(object):
+    '''
+    File-like reader over pieces of COPY text (one or many lines each), so copy_expert sends rows to the server as
+    they are produced instead of building the whole file in memory. At most size characters plus one piece are held
+    at a time, however long the pieces are.
+    '''
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.pending = deque()
+        # characters of pending[0] already returned, and characters pending after those
+        self.offset = 0
+        self.buffered = 0
+
+    def read(self, size=-1):
+        # pull from lines only while less than size characters are at hand
+        while size < 0 or self.buffered < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            if line:
+                self.pending.append(line)
+                self.buffered += len(line)
+        if size < 0 or size > self.buffered:
+            size = self.buffered
+
+        chunks = []
+        needed = size
+        while needed > 0:
+            head = self.pending[0]
+            taken = head[self.offset:self.offset + needed]
+            chunks.append(taken)
+            needed -= len(taken)
+            self.offset += len(taken)
+            if self.offset == len(head):
+                self.pending.popleft()
+                self.offset = 0
+        self.buffered -= size
+        return ''.join(chunks)
+
+
+def copy_value(value):
+    # one field in COPY text format: NULL as \N, lists as array literals and text with its specials escaped
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join('NULL' if v is None else repr(float(v)) for v in value) + '}'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_lines(cur, table, columns, lines):
+    # stream lines already in COPY text format (tab separated, newline terminated) into table
+    cur.copy_expert('COPY {0} ({1}) FROM STDIN'.format(table, ', '.join(columns)), CopyStream(lines),
+                    size=copy_buffer_size)
+
+
+def copy_rows(cur, table, columns, rows):
+    copy_lines(cur, table, columns, ('\t'.join(copy_value(value) for value in row) + '\n' for row in rows))
@@ -0,0 +1,249 @@
+import os, pickle, hashlib, threading, tempfile, fcntl
+from collections import OrderedDict
+
+
+checksums = {}
+
+
+def file_checksum(path):
+    # sha1 of a file, recomputed only when its size or modification time changes
+    stat = os.stat(path)
+    cache_key = (path, stat.st_size, stat.st_mtime)
+    checksum = checksums.get(cache_key)
+    if checksum is None:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        checksum = sha1.hexdigest()
+        checksums[cache_key] = checksum
+    return checksum
+
+
+class MemoryCache(object):
+    '''
+    In-process LRU cache bounded by the total byte size of the cached values
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.size += nbytes
+            # evict least recently used entries until the cache fits again
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def stats(self):
+        with self.lock:
+            return {'backend': 'memory', 'entries': len(self.entries), 'bytes': self.size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+class DiskCache(object):
+    '''
+    LRU cache shared by every process on the server through a directory of pickle files.
+    A file's modification time is its last use, so eviction removes the oldest files first.
+    '''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def file_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def get(self, key):
+        path = self.file_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        # write to a temporary file first so other processes never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.file_path(key))
+        self.evict()
+
+    def list_files(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # removed by another process in the meantime
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        return files
+
+    def evict(self):
+        files = self.list_files()
+        size = sum(f[1] for f in files)
+        for mtime, file_size, name in sorted(files):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            size -= file_size
+
+    def stats(self):
+        files = self.list_files()
+        return {'backend': 'disk', 'entries': len(files), 'bytes': sum(f[1] for f in files),
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+class FileCache(object):
+    '''
+    Directory of generated files shared by every process on the server, each named by a hash of its key.
+    Concurrent requests for the same missing key wait for a single computation (a thread lock within a process and
+    a lock file across processes), and the least recently used files are removed once the directory grows past
+    max_bytes.
+    '''
+
+    def __init__(self, path, max_bytes, suffix=''):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def file_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + self.suffix)
+
+    def touch(self, path):
+        # mark a cached file as used; False if it does not exist (or was just evicted)
+        try:
+            os.utime(path, None)
+            return True
+        except OSError:
+            return False
+
+    def key_lock(self, path):
+        with self.locks_lock:
+            return self.locks.setdefault(path, threading.Lock())
+
+    def get(self, key):
+        # path of the cached file for key, or None when it has not been created
+        path = self.file_path(key)
+        if self.touch(path):
+            self.hits += 1
+            return path
+        return None
+
+    def get_or_create(self, key, create):
+        '''
+        Path of the cached file for key. If it is missing, create(tmp_path) writes it, once, while every other
+        request for the same key waits
+        '''
+        path = self.file_path(key)
+        if self.touch(path):
+            self.hits += 1
+            return path
+
+        try:
+            with self.key_lock(path):
+                with open(path + '.lock', 'w') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        # another thread or process may have created it while this one waited
+                        if self.touch(path):
+                            self.hits += 1
+                            return path
+                        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+                        os.close(fd)
+                        try:
+                            create(tmp_path)
+                            os.replace(tmp_path, path)
+                        except Exception:
+                            if os.path.exists(tmp_path):
+                                os.remove(tmp_path)
+                            raise
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            # threads already waiting hold the lock object itself; later requests find the file, or lock a new one
+            with self.locks_lock:
+                self.locks.pop(path, None)
+        self.misses += 1
+        self.evict(keep=path)
+        return path
+
+    def list_files(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(self.suffix) and not name.endswith(('.lock', '.tmp')):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # removed by another process in the meantime
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        return files
+
+    def evict(self, keep=None):
+        files = self.list_files()
+        size = sum(f[1] for f in files)
+        for mtime, file_size, name in sorted(files):
+            if size <= self.max_bytes:
+                break
+            if os.path.join(self.path, name) == keep:
+                continue
+            # the key's lock file goes with it; at worst a request racing this removal repeats a create
+            for evicted in (name, name + '.lock'):
+                try:
+                    os.remove(os.path.join(self.path, evicted))
+                except OSError:
+                    pass
+            size -= file_size
+
+    def stats(self):
+        files = self.list_files()
+        return {'backend': 'files', 'entries': len(files), 'bytes': sum(f[1] for f in files),
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def make_cache(settings):
+    if settings['backend'] == 'disk':
+        return DiskCache(settings['path'], settings['max_bytes'])
+    return MemoryCache(settings['max_bytes'])
@@ -5,8 +5,6 @@ temp_workspace = os.path.join(swatdv.get_app_workspace().path, 'swat')
 
 data_path = os.path.join('/home/ubuntu/swat_data/')
 
-gdalwarp_path = os.path.join('/home/ubuntu/tethys/miniconda/envs/tethys/bin/gdalwarp')
-
 geoserver = {'rest_url':'http://216.218.240.206:8080/geoserver/rest/',
              'wms_url':'http://216.218.240.206:8080/geoserver/wms/',
              'user':'admin',
@@ -24,4 +22,42 @@ nasaaccess_py3 = os.path.join('/home/ubuntu/tethys/miniconda/envs/nasaaccess/bin
 
 nasaaccess_script = os.path.join('/home/ubuntu/subprocesses/nasaaccess.py')
 
-nasaaccess_log = os.path.join('/home/ubuntu/subprocesses/nasaaccess.log')
\ No newline at end of file
+nasaaccess_log = os.path.join('/home/ubuntu/subprocesses/nasaaccess.log')
+
+# storage engine for output.rch/output.sub series: 'rows' (one row per value), 'array' (one real[] per series) or
+# 'cube' (memory-mapped output_rch.npy/output_sub.npy files in each watershed's Outputs folder)
+output_storage = 'rows'
+
+# cache for timeseries query results; 'memory' is per process, 'disk' is shared by all processes through path.
+# Cached results are keyed by the watershed's data version, which is re-read at most every version_ttl seconds
+series_cache = {'backend': 'memory',
+                'max_bytes': 256 * 1024 * 1024,
+                'version_ttl': 5,
+                'path': os.path.join(swatdv.get_app_workspace().path, 'series_cache')}
+
+# connection pool for the shared engine in database.py; connections are recycled after pool_recycle seconds and
+# checked before use so a restarted database does not surface as a failed request
+db_pool = {'pool_size': 5,
+           'max_overflow': 10,
+           'pool_recycle': 1800,
+           'pool_pre_ping': True}
+
+# dissolved upstream subbasin/reach geometry per outlet, shared by all processes through path; tolerance (degrees)
+# is the simplification applied before the GeoJSON is cached
+upstream_geometry_cache = {'path': os.path.join(swatdv.get_app_workspace().path, 'upstream_geometry'),
+                           'tolerance': 0.0001}
+
+# clipped lulc/soil rasters shared by all users, keyed by watershed, outlet, raster type and source checksum
+clip_cache = {'path': os.path.join(swatdv.get_app_workspace().path, 'clip_cache'),
+              'max_bytes': 2 * 1024 * 1024 * 1024}
+
+# PNG tiles of clipped rasters rendered by the app, kept in memory up to max_bytes and cacheable by browsers for
+# max_age seconds
+clip_tiles = {'max_bytes': 64 * 1024 * 1024,
+              'max_age': 3600}
+
+# background jobs for clipping rasters: the number of worker threads per process, where job status
+# files are kept and how long (seconds) they are kept
+clip_jobs = {'path': os.path.join(swatdv.get_app_workspace().path, 'jobs'),
+             'workers': 2,
+             'max_age': 24 * 3600}
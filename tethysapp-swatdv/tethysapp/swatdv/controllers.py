@@ -1,21 +1,19 @@
 from django.shortcuts import *
 from tethys_sdk.gizmos import *
 from datetime import datetime
-from .app import swatdv
 from .model import *
 from .config import *
-from sqlalchemy.sql import text
+from .database import query, track_queries
 
+@track_queries
 def home(request):
     """
     Controller for the Output Viewer page.
     """
     # Get available watersheds and set select_watershed options
-    Session = swatdv.get_persistent_store_database(db['name'], as_sessionmaker=True)
-    session = Session()
     # Query DB for regions
     wqr = """SELECT * FROM watershed"""
-    watersheds = session.execute(text(wqr)).fetchall()
+    watersheds = query(wqr)
 
     watershed_options = []
 
@@ -109,7 +107,23 @@ def home(request):
                                                   'allowClear': False},
                                  )
 
-    session.close()
+    timestep_options = [('Daily', 'Daily'), ('Monthly', 'Monthly'), ('Annual', 'Annual')]
+
+    rch_timestep_select = SelectInput(name='rch_timestep_select',
+                                      multiple=False,
+                                      original=False,
+                                      classes='rch_timestep',
+                                      options=timestep_options,
+                                      initial=['Daily'],
+                                      )
+
+    sub_timestep_select = SelectInput(name='sub_timestep_select',
+                                      multiple=False,
+                                      original=False,
+                                      classes='sub_timestep',
+                                      options=timestep_options,
+                                      initial=['Daily'],
+                                      )
 
     context = {
         'rch_start_pick': rch_start_pick,
@@ -120,6 +134,8 @@ def home(request):
         'sub_end_pick': sub_end_pick,
         'rch_var_select': rch_var_select,
         'sub_var_select': sub_var_select,
+        'rch_timestep_select': rch_timestep_select,
+        'sub_timestep_select': sub_timestep_select,
         'watershed_select': watershed_select,
     }
 
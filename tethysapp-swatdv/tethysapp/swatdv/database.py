@@ -0,0 +1,142 @@
+import re, time, threading, logging
+from functools import wraps
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql import text
+from .app import swatdv
+from .config import db, db_pool
+
+# Shared data access for swatdv: one engine (and connection pool) per process instead of one per request, and
+# server-side prepared statements for the queries every AJAX call runs.
+
+# name: (argument types, query). Statements with {0}/{1} are prepared once per file type as <name>_rch/<name>_sub.
+prepared_statements = {
+    'series_rows': ('integer, integer[], text[], date, date',
+                    """SELECT {1}, var_name, year_month_day, val FROM output_{0} WHERE watershed_id=$1
+                       AND {1} = ANY($2) AND var_name = ANY($3) AND year_month_day BETWEEN $4 AND $5
+                       ORDER BY {1}, var_name, year_month_day"""),
+    'series_array': ('integer, integer[], smallint[], date, date',
+                     """SELECT {1}, var_id, GREATEST(start_date, $4), vals[($4 - start_date) + 1:($5 - start_date) + 1]
+                        FROM output_{0}_series WHERE watershed_id=$1 AND {1} = ANY($2) AND var_id = ANY($3)"""),
+    'rollup': ('integer, integer, text[], text, date, date',
+               """SELECT var_name, period, val_sum, val_mean, val_min, val_max FROM output_{0}_rollup
+                  WHERE watershed_id=$1 AND {1}=$2 AND var_name = ANY($3) AND timestep=$4 AND period BETWEEN $5 AND $6
+                  ORDER BY var_name, period"""),
+    'stream_connect': ('integer',
+                       """SELECT stream_id, to_node, area_km2 FROM stream_connect WHERE watershed_id=$1"""),
+    'lulc_key': ('integer',
+                 """SELECT value, lulc, lulc_class, lulc_subclass, class_color, subclass_color FROM lulc
+                    WHERE watershed_id=$1"""),
+    'soil_key': ('integer',
+                 """SELECT value, soil_class, class_color FROM soil WHERE watershed_id=$1"""),
+    'coverage_histogram': ('integer, text, integer[]',
+                           """SELECT value, SUM(pixels) FROM coverage_histogram WHERE watershed_id=$1 AND raster_type=$2
+                              AND sub_id = ANY($3) GROUP BY value ORDER BY value"""),
+    'watershed_info': ('integer',
+                       """SELECT sub, rch, lulc, soil, stations, nasaaccess, rch_start, rch_end, rch_vars, sub_start,
+                          sub_end, sub_vars FROM watershed_info WHERE watershed_id=$1"""),
+    'data_version': ('integer',
+                     """SELECT data_version FROM watershed WHERE id=$1"""),
+}
+
+id_columns = {'rch': 'reach_id', 'sub': 'sub_id'}
+
+engine = None
+engine_lock = threading.Lock()
+request_stats = threading.local()
+
+
+def get_engine():
+    global engine
+    if engine is None:
+        with engine_lock:
+            if engine is None:
+                url = swatdv.get_persistent_store_database(db['name'], as_url=True)
+                new_engine = create_engine(url, **db_pool)
+                event.listen(new_engine, 'connect', prepare_statements)
+                event.listen(new_engine, 'before_cursor_execute', before_cursor_execute)
+                event.listen(new_engine, 'after_cursor_execute', after_cursor_execute)
+                engine = new_engine
+    return engine
+
+
+def prepare_statements(dbapi_connection, connection_record):
+    # prepared statements live as long as the pooled connection, so each one is planned once per connection
+    cursor = dbapi_connection.cursor()
+    for name, (arg_types, query) in prepared_statements.items():
+        variants = [(name + '_' + file_type, query.format(file_type, id_column))
+                    for file_type, id_column in id_columns.items()] if '{0}' in query else [(name, query)]
+        for statement_name, statement in variants:
+            try:
+                cursor.execute('PREPARE {0} ({1}) AS {2}'.format(statement_name, arg_types, statement))
+                dbapi_connection.commit()
+            except Exception as e:
+                # e.g. a table that does not exist yet in an older database; that statement is run unprepared
+                dbapi_connection.rollback()
+                logging.warning('could not prepare {0}: {1}'.format(statement_name, e))
+    cursor.close()
+    connection_record.info['prepared'] = prepared_names(dbapi_connection)
+
+
+def prepared_names(dbapi_connection):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SELECT name FROM pg_prepared_statements')
+    names = set(row[0] for row in cursor.fetchall())
+    cursor.close()
+    dbapi_connection.commit()
+    return names
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info['query_start'].pop()
+    request_stats.queries = getattr(request_stats, 'queries', 0) + 1
+    request_stats.seconds = getattr(request_stats, 'seconds', 0.0) + elapsed
+
+
+def plain_statement(name):
+    # the query behind a prepared statement name, with $n placeholders turned into bound :p(n-1) parameters
+    for file_type, id_column in id_columns.items():
+        if name.endswith('_' + file_type) and name[:-len(file_type) - 1] in prepared_statements:
+            statement = prepared_statements[name[:-len(file_type) - 1]][1].format(file_type, id_column)
+            break
+    else:
+        statement = prepared_statements[name][1]
+    return re.sub(r'\$(\d+)', lambda match: ':p{0}'.format(int(match.group(1)) - 1), statement)
+
+
+def fetch(name, *args):
+    # run a prepared statement (falling back to the plain query if it could not be prepared) and return all rows
+    params = dict(('p{0}'.format(i), arg) for i, arg in enumerate(args))
+    with get_engine().connect() as connection:
+        if name in connection.connection.info.get('prepared', ()):
+            statement = 'EXECUTE {0}({1})'.format(name, ', '.join(':p{0}'.format(i) for i in range(len(args))))
+        else:
+            statement = plain_statement(name)
+        return connection.execute(text(statement), params).fetchall()
+
+
+def query(statement, params=None):
+    # ad-hoc bound-parameter query through the shared pool
+    with get_engine().connect() as connection:
+        return connection.execute(text(statement), params or {}).fetchall()
+
+
+def track_queries(controller):
+    '''
+    Decorator for controllers that counts the queries a request runs and the time spent in them. The totals are
+    logged and returned in the X-DB-Queries and X-DB-Time response headers.
+    '''
+    @wraps(controller)
+    def wrapper(request, *args, **kwargs):
+        request_stats.queries = 0
+        request_stats.seconds = 0.0
+        response = controller(request, *args, **kwargs)
+        response['X-DB-Queries'] = str(request_stats.queries)
+        response['X-DB-Time'] = '{0:.4f}'.format(request_stats.seconds)
+        logging.debug('{0}: {1} queries in {2:.4f}s'.format(controller.__name__, request_stats.queries,
+                                                            request_stats.seconds))
+        return response
+    return wrapper
@@ -0,0 +1,79 @@
+import os, re, json, time, uuid, logging, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueue(object):
+    '''
+    Bounded pool of background threads for slow work such as clipping rasters, so request threads
+    return right away. Each job's status is a small JSON file under path, which lets any server process answer a
+    status request; identical jobs submitted while one is still running share it.
+    '''
+
+    def __init__(self, path, workers, max_age):
+        self.path = path
+        self.max_age = max_age
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.running = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def status_path(self, job_id):
+        return os.path.join(self.path, job_id + '.json')
+
+    def status(self, job_id):
+        # None for unknown (or malformed) job ids
+        if not re.match('^[0-9a-f]{32}$', str(job_id)):
+            return None
+        try:
+            with open(self.status_path(job_id)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def update(self, job_id, **status):
+        current = self.status(job_id) or {}
+        current.update(status)
+        # write to a temporary file first so a status request never reads a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(current, f)
+        os.replace(tmp_path, self.status_path(job_id))
+
+    def submit(self, key, function, *args, **info):
+        '''
+        Run function(progress, *args) on the pool and return the job id. progress(fraction, stage) reports how far
+        the job is, and the dict function returns is added to the final status
+        '''
+        with self.lock:
+            if key in self.running:
+                return self.running[key]
+            job_id = uuid.uuid4().hex
+            self.running[key] = job_id
+        self.expire()
+        self.update(job_id, id=job_id, status='queued', stage='queued', progress=0.0, **info)
+        self.executor.submit(self.run, key, job_id, function, args)
+        return job_id
+
+    def run(self, key, job_id, function, args):
+        def progress(fraction, stage):
+            self.update(job_id, status='running', stage=stage, progress=round(fraction, 3))
+        try:
+            result = function(progress, *args)
+            self.update(job_id, status='done', stage='done', progress=1.0, **result)
+        except Exception as e:
+            logging.exception('job {0} failed'.format(job_id))
+            self.update(job_id, status='failed', error=str(e))
+        finally:
+            with self.lock:
+                del self.running[key]
+
+    def expire(self):
+        # status files of jobs older than max_age are removed
+        cutoff = time.time() - self.max_age
+        for name in os.listdir(self.path):
+            try:
+                if os.stat(os.path.join(self.path, name)).st_mtime < cutoff:
+                    os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
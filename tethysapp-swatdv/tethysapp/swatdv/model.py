@@ -1,17 +1,20 @@
-from tethys_sdk.services import get_spatial_dataset_engine
 from .config import *
 from .outputs_config import *
-from osgeo import gdal
+from osgeo import gdal, ogr, osr
 from datetime import datetime
-from collections import OrderedDict
 import numpy as np
 import pandas as pd
-import os, subprocess, requests, zipfile, random, string, logging
+import os, re, subprocess, zipfile, random, string, logging, json, tempfile, uuid, shutil, time
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, Float, String, ForeignKey, Date
+from sqlalchemy import Column, Integer, SmallInteger, Float, String, ForeignKey, Date, Index
+from sqlalchemy.dialects.postgresql import ARRAY, REAL
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import text
-from .app import swatdv
+from .cache import make_cache, file_checksum, MemoryCache, FileCache
+from .jobs import JobQueue
+from .database import fetch
+from .river_network import RiverNetwork
+from .series_encoding import epoch_ms, series_pairs, lttb, pack_timeseries
 
 # PostgreSQL db setup
 Base = declarative_base()
@@ -25,6 +28,8 @@ class Watershed(Base):
     # Columns
     id = Column(Integer, primary_key=True)
     name = Column(String)
+    # bumped whenever the watershed's outputs are (re)loaded so cached results from older data are never served
+    data_version = Column(Integer, default=1, server_default='1')
 
     def __init__(self, name):
         self.name = name
@@ -73,11 +78,15 @@ class RCH(Base):
     '''
 
     __tablename__ = 'output_rch'
+    __table_args__ = (Index('ix_output_rch_lookup', 'watershed_id', 'reach_id', 'var_name', 'year_month_day'),
+                      Index('ix_output_rch_date', 'year_month_day', postgresql_using='brin'),
+                      {'postgresql_partition_by': 'LIST (watershed_id)'})
 
     # Table Columns
 
-    id = Column(Integer, primary_key=True)
-    watershed_id = Column(Integer, ForeignKey('watershed.id'))
+    # the partition key has to be part of the primary key of a partitioned table
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    watershed_id = Column(Integer, ForeignKey('watershed.id'), primary_key=True)
     year_month_day = Column(Date)
     reach_id = Column(Integer)
     var_name = Column(String)
@@ -99,11 +108,15 @@ class SUB(Base):
     '''
 
     __tablename__ = 'output_sub'
+    __table_args__ = (Index('ix_output_sub_lookup', 'watershed_id', 'sub_id', 'var_name', 'year_month_day'),
+                      Index('ix_output_sub_date', 'year_month_day', postgresql_using='brin'),
+                      {'postgresql_partition_by': 'LIST (watershed_id)'})
 
     # Table Columns
 
-    id = Column(Integer, primary_key=True)
-    watershed_id = Column(Integer, ForeignKey('watershed.id'))
+    # the partition key has to be part of the primary key of a partitioned table
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    watershed_id = Column(Integer, ForeignKey('watershed.id'), primary_key=True)
     year_month_day = Column(Date)
     sub_id = Column(Integer)
     var_name = Column(String)
@@ -119,6 +132,130 @@ class SUB(Base):
         self.var_name = var_name
         self.val = val
 
+class RCH_SERIES(Base):
+    '''
+    Array-per-series SQLAlchemy DB Model for output.rch (used when output_storage = 'array')
+    '''
+
+    __tablename__ = 'output_rch_series'
+    __table_args__ = (Index('ix_output_rch_series_lookup', 'watershed_id', 'reach_id', 'var_id', unique=True),)
+
+    # Table Columns
+
+    id = Column(Integer, primary_key=True)
+    watershed_id = Column(Integer, ForeignKey('watershed.id'))
+    reach_id = Column(Integer)
+    var_id = Column(SmallInteger)
+    start_date = Column(Date)
+    vals = Column(ARRAY(REAL))
+
+    def __init__(self, watershed_id, reach_id, var_id, start_date, vals):
+        """
+        Constructor for the table
+        """
+        self.watershed_id = watershed_id
+        self.reach_id = reach_id
+        self.var_id = var_id
+        self.start_date = start_date
+        self.vals = vals
+
+class SUB_SERIES(Base):
+    '''
+    Array-per-series SQLAlchemy DB Model for output.sub (used when output_storage = 'array')
+    '''
+
+    __tablename__ = 'output_sub_series'
+    __table_args__ = (Index('ix_output_sub_series_lookup', 'watershed_id', 'sub_id', 'var_id', unique=True),)
+
+    # Table Columns
+
+    id = Column(Integer, primary_key=True)
+    watershed_id = Column(Integer, ForeignKey('watershed.id'))
+    sub_id = Column(Integer)
+    var_id = Column(SmallInteger)
+    start_date = Column(Date)
+    vals = Column(ARRAY(REAL))
+
+    def __init__(self, watershed_id, sub_id, var_id, start_date, vals):
+        """
+        Constructor for the table
+        """
+        self.watershed_id = watershed_id
+        self.sub_id = sub_id
+        self.var_id = var_id
+        self.start_date = start_date
+        self.vals = vals
+
+class RCH_ROLLUP(Base):
+    '''
+    Monthly and annual aggregates of output.rch computed at upload
+    '''
+
+    __tablename__ = 'output_rch_rollup'
+    __table_args__ = (Index('ix_output_rch_rollup_lookup', 'watershed_id', 'reach_id', 'var_name', 'timestep', 'period'),)
+
+    # Table Columns
+
+    id = Column(Integer, primary_key=True)
+    watershed_id = Column(Integer, ForeignKey('watershed.id'))
+    reach_id = Column(Integer)
+    var_name = Column(String)
+    timestep = Column(String)
+    period = Column(Date)
+    val_sum = Column(Float)
+    val_mean = Column(Float)
+    val_min = Column(Float)
+    val_max = Column(Float)
+
+    def __init__(self, watershed_id, reach_id, var_name, timestep, period, val_sum, val_mean, val_min, val_max):
+        """
+        Constructor for the table
+        """
+        self.watershed_id = watershed_id
+        self.reach_id = reach_id
+        self.var_name = var_name
+        self.timestep = timestep
+        self.period = period
+        self.val_sum = val_sum
+        self.val_mean = val_mean
+        self.val_min = val_min
+        self.val_max = val_max
+
+class SUB_ROLLUP(Base):
+    '''
+    Monthly and annual aggregates of output.sub computed at upload
+    '''
+
+    __tablename__ = 'output_sub_rollup'
+    __table_args__ = (Index('ix_output_sub_rollup_lookup', 'watershed_id', 'sub_id', 'var_name', 'timestep', 'period'),)
+
+    # Table Columns
+
+    id = Column(Integer, primary_key=True)
+    watershed_id = Column(Integer, ForeignKey('watershed.id'))
+    sub_id = Column(Integer)
+    var_name = Column(String)
+    timestep = Column(String)
+    period = Column(Date)
+    val_sum = Column(Float)
+    val_mean = Column(Float)
+    val_min = Column(Float)
+    val_max = Column(Float)
+
+    def __init__(self, watershed_id, sub_id, var_name, timestep, period, val_sum, val_mean, val_min, val_max):
+        """
+        Constructor for the table
+        """
+        self.watershed_id = watershed_id
+        self.sub_id = sub_id
+        self.var_name = var_name
+        self.timestep = timestep
+        self.period = period
+        self.val_sum = val_sum
+        self.val_mean = val_mean
+        self.val_min = val_min
+        self.val_max = val_max
+
 class LULC(Base):
     '''
     LULC SQLAlchemy DB Model
@@ -149,6 +286,33 @@ class LULC(Base):
         self.class_color = class_color
         self.subclass_color = subclass_color
 
+class COVERAGE_HISTOGRAM(Base):
+    '''
+    Pixel count of each lulc/soil class within each subbasin, computed by upload_new_model.py
+    '''
+
+    __tablename__ = 'coverage_histogram'
+    __table_args__ = (Index('ix_coverage_histogram_lookup', 'watershed_id', 'raster_type', 'sub_id'),)
+
+    # Table Columns
+
+    id = Column(Integer, primary_key=True)
+    watershed_id = Column(Integer, ForeignKey('watershed.id'))
+    raster_type = Column(String)
+    sub_id = Column(Integer)
+    value = Column(Integer)
+    pixels = Column(Integer)
+
+    def __init__(self, watershed_id, raster_type, sub_id, value, pixels):
+        """
+        Constructor for the table
+        """
+        self.watershed_id = watershed_id
+        self.raster_type = raster_type
+        self.sub_id = sub_id
+        self.value = value
+        self.pixels = pixels
+
 class SOIL(Base):
     '''
     Soil SQLAlchemy DB Model
@@ -186,204 +350,878 @@ class STREAM_CONNECT(Base):
     watershed_id = Column(Integer, ForeignKey('watershed.id'))
     stream_id = Column(Integer)
     to_node = Column(Integer)
+    # area of the reach's subbasin, from output.sub
+    area_km2 = Column(Float)
 
-    def __init__(self, watershed_id, stream_id, to_node):
+    def __init__(self, watershed_id, stream_id, to_node, area_km2=None):
         """
         Constructor for the table
         """
         self.watershed_id = watershed_id
         self.stream_id = stream_id
         self.to_node = to_node
+        self.area_km2 = area_km2
+
+partitioned_tables = ['output_rch', 'output_sub']
 
 def init_db(engine,first_time):
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text("""ALTER TABLE watershed ADD COLUMN IF NOT EXISTS data_version INTEGER DEFAULT 1"""))
+        # the network's upstream intervals are computed in memory by RiverNetwork; installs that stored them in
+        # stream_connect drop those columns (and their index) so there is one source of truth
+        connection.execute(text("""ALTER TABLE stream_connect ADD COLUMN IF NOT EXISTS area_km2 FLOAT,
+                                  DROP COLUMN IF EXISTS lft, DROP COLUMN IF EXISTS rgt"""))
+        for table in partitioned_tables:
+            if is_partitioned(connection, table):
+                connection.execute(text("""CREATE TABLE IF NOT EXISTS {0}_default PARTITION OF {0} DEFAULT""".format(table)))
+            else:
+                # create_all does not add indexes to tables that already exist, so plain output tables from older
+                # installs get the lookup and date indexes here
+                id_column = 'reach_id' if table == 'output_rch' else 'sub_id'
+                connection.execute(text("""CREATE INDEX IF NOT EXISTS ix_{0}_lookup
+                                          ON {0} (watershed_id, {1}, var_name, year_month_day)""".format(table, id_column)))
+                connection.execute(text("""CREATE INDEX IF NOT EXISTS ix_{0}_date ON {0} USING brin (year_month_day)"""
+                                        .format(table)))
+        for watershed in connection.execute(text("""SELECT id FROM watershed""")).fetchall():
+            create_watershed_partitions(connection, watershed[0])
     if first_time:
         Session = sessionmaker(bind=engine)
         session = Session()
         session.commit()
         session.close()
 
+def is_partitioned(connection, table):
+    # output tables created before partitioning was introduced are plain tables and are not repartitioned
+    relkind_qr = """SELECT relkind FROM pg_class WHERE relname=:table"""
+    records = connection.execute(text(relkind_qr), {'table': table}).fetchall()
+    return len(records) > 0 and records[0][0] == 'p'
+
+def create_watershed_partitions(connection, watershed_id):
+    # give a watershed its own partition of each output table so its queries never scan other watersheds. Rows the
+    # watershed already has in the default partition (loaded before partitioning) are moved into the new partition;
+    # the default is detached meanwhile because a partition cannot be created while the default holds its rows
+    watershed_id = int(watershed_id)
+    for table in partitioned_tables:
+        partition = '{0}_{1}'.format(table, watershed_id)
+        if not is_partitioned(connection, table) or \
+                connection.execute(text("""SELECT 1 FROM pg_class WHERE relname=:partition"""),
+                                   {'partition': partition}).fetchall():
+            continue
+        in_default = connection.execute(text("""SELECT 1 FROM {0}_default WHERE watershed_id=:watershed_id LIMIT 1"""
+                                             .format(table)), {'watershed_id': watershed_id}).fetchall()
+        if in_default:
+            connection.execute(text("""ALTER TABLE {0} DETACH PARTITION {0}_default""".format(table)))
+        connection.execute(text("""CREATE TABLE {1} PARTITION OF {0} FOR VALUES IN ({2})"""
+                                .format(table, partition, watershed_id)))
+        if in_default:
+            connection.execute(text("""INSERT INTO {1} SELECT * FROM {0}_default WHERE watershed_id=:watershed_id"""
+                                    .format(table, partition)), {'watershed_id': watershed_id})
+            connection.execute(text("""DELETE FROM {0}_default WHERE watershed_id=:watershed_id""".format(table)),
+                               {'watershed_id': watershed_id})
+            connection.execute(text("""ALTER TABLE {0} ATTACH PARTITION {0}_default DEFAULT""".format(table)))
+
 
 # Data extraction functions
-def extract_daily_rch(watershed, watershed_id, start, end, parameters, reachid):
-    dt_start = datetime.strptime(start, '%B %d, %Y').strftime('%Y-%m-%d')
-    dt_end = datetime.strptime(end, '%B %d, %Y').strftime('%Y-%m-%d')
-    daterange = pd.date_range(start, end, freq='1d')
-    daterange = daterange.union([daterange[-1]])
-    daterange_str = [d.strftime('%b %d, %Y') for d in daterange]
-    daterange_mil = [int(d.strftime('%s')) * 1000 for d in daterange]
-
-    rchDict = {'Watershed': watershed,
-               'Dates': daterange_str,
-               'ReachID': reachid,
+output_column_lists = {'rch': rch_column_list,
+                       'sub': sub_column_list}
+
+output_param_names = {'rch': rch_param_names,
+                      'sub': sub_param_names}
+
+# numpy unit and date label for each rollup timestep
+rollup_periods = {'Monthly': ('M', '%b %y'),
+                  'Annual': ('Y', '%Y')}
+
+rollup_stat_columns = ['sum', 'mean', 'min', 'max']
+
+timeseries_cache = make_cache(series_cache)
+
+data_versions = {}
+
+def data_version(watershed_id):
+    # a watershed's data version, bumped by every upload. It is looked up at most once every version_ttl seconds,
+    # so the several caches one request consults share a single query; a new upload shows within that time
+    watershed_id = int(watershed_id)
+    now = time.time()
+    version = data_versions.get(watershed_id)
+    if version is None or now - version[1] >= series_cache['version_ttl']:
+        version = (fetch('data_version', watershed_id)[0][0], now)
+        data_versions[watershed_id] = version
+    return version[0]
+
+def cached_series(key, watershed_id, compute):
+    # (axis, values) arrays are cached per data version of the watershed, so uploads invalidate old entries
+    key = (watershed_id, data_version(watershed_id)) + key
+    series = timeseries_cache.get(key)
+    if series is None:
+        series = compute()
+        timeseries_cache.put(key, series, series[0].nbytes + series[1].nbytes)
+    return series
+
+def daily_axis(start, end):
+    # every day from start to end (inclusive) as datetime64[D]
+    dt_start = np.datetime64(datetime.strptime(start, '%B %d, %Y').date())
+    dt_end = np.datetime64(datetime.strptime(end, '%B %d, %Y').date())
+    return np.arange(dt_start, dt_end + 1)
+
+def query_series(file_type, watershed, watershed_id, object_id, parameters, days):
+    return query_series_many(file_type, watershed, watershed_id, [object_id], parameters, days)[0]
+
+def query_series_many(file_type, watershed, watershed_id, object_ids, parameters, days):
+    # fetch every requested reach/subbasin and variable in one query and pivot it onto the day axis as
+    # values[object, parameter, day]; days without a value stay NaN
+    object_ids = [int(object_id) for object_id in object_ids]
+    if output_storage == 'array':
+        return query_series_array(file_type, watershed_id, object_ids, parameters, days)
+    if output_storage == 'cube':
+        return query_series_cube(file_type, watershed, object_ids, parameters, days)
+
+    values = np.full((len(object_ids), len(parameters), len(days)), np.nan)
+    records = fetch('series_rows_' + file_type, watershed_id, object_ids, list(parameters), days[0].item(),
+                    days[-1].item())
+
+    if len(records) > 0:
+        ids, var_names, dates, vals = zip(*records)
+        cols = (np.asarray(dates, dtype='datetime64[D]') - days[0]).astype(np.int64)
+        values[index_of(object_ids, ids), index_of(parameters, var_names), cols] = np.asarray(vals, dtype=np.float64)
+    return values
+
+def index_of(choices, items):
+    # position in choices of every item, looked up with one sort instead of a list.index per item
+    choices = np.asarray(choices)
+    order = np.argsort(choices)
+    return order[np.searchsorted(choices[order], np.asarray(items))]
+
+def pivot_records(records, parameters, axis, values):
+    # scatter (var_name, date, val) rows into values[parameter, position on axis]
+    if len(records) > 0:
+        var_names, dates, vals = zip(*records)
+        cols = (np.asarray(dates, dtype='datetime64[D]').astype(axis.dtype) - axis[0]).astype(np.int64)
+        values[index_of(parameters, var_names), cols] = np.asarray(vals, dtype=np.float64)
+
+def query_series_array(file_type, watershed_id, object_ids, parameters, days):
+    # one row per series; postgres slices each stored array down to the requested window before sending it
+    var_ids = [output_column_lists[file_type].index(param) for param in parameters]
+    values = np.full((len(object_ids), len(parameters), len(days)), np.nan)
+    records = fetch('series_array_' + file_type, watershed_id, object_ids, var_ids, days[0].item(), days[-1].item())
+
+    for object_id, var_id, first_day, vals in records:
+        if not vals:
+            continue
+        offset = int((np.datetime64(first_day, 'D') - days[0]).astype(np.int64))
+        values[object_ids.index(object_id), var_ids.index(var_id), offset:offset + len(vals)] = np.asarray(
+            vals, dtype=np.float64)
+    return values
+
+cube_handles = {}
+
+def open_cube(file_type, watershed):
+    # memory-map the [variable][reach/sub][day] float32 array written at upload; maps are reused while the file is unchanged
+    cube_path = os.path.join(data_path, watershed, 'Outputs', 'output_' + file_type + '.npy')
+    mtime = os.path.getmtime(cube_path)
+    handle = cube_handles.get(cube_path)
+    if handle is None or handle[0] != mtime:
+        with open(os.path.join(data_path, watershed, 'Outputs', 'output_' + file_type + '.json')) as f:
+            meta = json.load(f)
+        ids = np.asarray(meta['ids'])
+        handle = (mtime, np.load(cube_path, mmap_mode='r'), np.datetime64(meta['start'], 'D'), list(meta['vars']),
+                  dict(zip(ids.tolist(), range(len(ids)))))
+        cube_handles[cube_path] = handle
+    return handle[1:]
+
+def query_series_cube(file_type, watershed, object_ids, parameters, days):
+    cube, cube_start, cube_vars, cube_ids = open_cube(file_type, watershed)
+    values = np.full((len(object_ids), len(parameters), len(days)), np.nan)
+    rows = [i for i in range(len(object_ids)) if object_ids[i] in cube_ids]
+
+    # clip the requested window to the days stored in the cube
+    first = max(int((days[0] - cube_start).astype(np.int64)), 0)
+    last = min(int((days[-1] - cube_start).astype(np.int64)) + 1, cube.shape[2])
+    if last <= first or len(rows) == 0:
+        return values
+    offset = first - int((days[0] - cube_start).astype(np.int64))
+    id_idx = [cube_ids[object_ids[i]] for i in rows]
+    for x in range(0, len(parameters)):
+        if parameters[x] in cube_vars:
+            # slicing the memory map only reads the requested reaches and days from disk
+            var_cube = cube[cube_vars.index(parameters[x])]
+            if len(id_idx) == 1:
+                values[rows[0], x, offset:offset + last - first] = var_cube[id_idx[0], first:last]
+            else:
+                values[rows, x, offset:offset + last - first] = var_cube[id_idx, first:last]
+    return values
+
+def daily_series(file_type, watershed, watershed_id, start, end, parameters, object_id):
+    def compute():
+        days = daily_axis(start, end)
+        return days, query_series(file_type, watershed, watershed_id, object_id, parameters, days)
+    return cached_series((file_type, 'Daily', str(object_id), tuple(parameters), start, end), watershed_id, compute)
+
+def batch_series(file_type, watershed, watershed_id, start, end, parameters, object_ids):
+    def compute():
+        days = daily_axis(start, end)
+        return days, query_series_many(file_type, watershed, watershed_id, object_ids, parameters, days)
+    return cached_series((file_type, 'Batch', tuple(str(object_id) for object_id in object_ids), tuple(parameters),
+                          start, end), watershed_id, compute)
+
+def extract_batch(file_type, watershed, watershed_id, start, end, parameters, object_ids):
+    days, values = batch_series(file_type, watershed, watershed_id, start, end, parameters, object_ids)
+    return {'Watershed': watershed,
+            'FileType': file_type,
+            'IDs': object_ids,
+            'Parameters': parameters,
+            'Names': [output_param_names[file_type][param] for param in parameters],
+            'Dates': pd.DatetimeIndex(days).strftime('%b %d, %Y').tolist(),
+            'Times': epoch_ms(days).tolist(),
+            # Values[id][parameter][day], aligned with Times; missing values are null
+            'Values': np.where(np.isnan(values), None, values).tolist(),
+            'Timestep': 'Daily'}
+
+def extract_batch_binary(file_type, watershed, watershed_id, start, end, parameters, object_ids):
+    days, values = batch_series(file_type, watershed, watershed_id, start, end, parameters, object_ids)
+    header = {'Watershed': watershed,
+              'FileType': file_type,
+              'IDs': object_ids,
+              'Parameters': parameters,
+              'Names': [output_param_names[file_type][param] for param in parameters],
+              'Timestep': 'Daily'}
+    # blocks are ordered id by id, then parameter by parameter
+    return pack_timeseries(header, days, values.reshape(-1, len(days)))
+
+def extract_daily(file_type, watershed, watershed_id, start, end, parameters, object_id, max_points=None):
+    days, values = daily_series(file_type, watershed, watershed_id, start, end, parameters, object_id)
+    times = epoch_ms(days)
+
+    ts_dict = {'Watershed': watershed,
+               'WatershedID': watershed_id,
+               'Start': start,
+               'End': end,
+               'Dates': pd.DatetimeIndex(days).strftime('%b %d, %Y').tolist(),
+               'ReachID': object_id,
                'Parameters': parameters,
                'Values': {},
-               'Names': [],
+               'Names': [output_param_names[file_type][param] for param in parameters],
                'Timestep': 'Daily',
-               'FileType': 'rch'}
+               'FileType': file_type,
+               'MaxPoints': max_points}
 
-    Session = swatdv.get_persistent_store_database(db['name'], as_sessionmaker=True)
-    session = Session()
     for x in range(0, len(parameters)):
-        param_name = rch_param_names[parameters[x]]
-        rchDict['Names'].append(param_name)
-
-        rch_qr = """SELECT val FROM output_rch WHERE watershed_id={0} AND reach_id={1} AND var_name='{2}' AND year_month_day BETWEEN '{3}' AND '{4}'; """.format(
-            watershed_id, reachid, parameters[x], dt_start, dt_end)
-        data = session.execute(text(rch_qr)).fetchall()
-
-        ts = []
-        i = 0
-        while i < len(data):
-            ts.append([daterange_mil[i], data[i][0]])
-            i += 1
-
-        rchDict['Values'][x] = ts
-    session.close()
-    return rchDict
-
-def extract_sub(watershed, watershed_id, start, end, parameters, subid):
-    dt_start = datetime.strptime(start, '%B %d, %Y').strftime('%Y-%m-%d')
-    dt_end = datetime.strptime(end, '%B %d, %Y').strftime('%Y-%m-%d')
-    daterange = pd.date_range(start, end, freq='1d')
-    daterange = daterange.union([daterange[-1]])
-    daterange_str = [d.strftime('%b %d, %Y') for d in daterange]
-    daterange_mil = [int(d.strftime('%s')) * 1000 for d in daterange]
-
-    subDict = {'Watershed': watershed,
-               'Dates': daterange_str,
-               'ReachID': subid,
+        if max_points:
+            keep = lttb(times, values[x], max_points)
+            ts_dict['Values'][x] = series_pairs(times[keep], values[x][keep])
+        else:
+            ts_dict['Values'][x] = series_pairs(times, values[x])
+    return ts_dict
+
+def extract_daily_rch(watershed, watershed_id, start, end, parameters, reachid, max_points=None):
+    return extract_daily('rch', watershed, watershed_id, start, end, parameters, reachid, max_points)
+
+def extract_sub(watershed, watershed_id, start, end, parameters, subid, max_points=None):
+    return extract_daily('sub', watershed, watershed_id, start, end, parameters, subid, max_points)
+
+def rollup_stat(var_name):
+    # flows, concentrations, temperatures and storages are averaged over a period; depths, masses and counts add up
+    if var_name in rollup_mean_vars or var_name.endswith(rollup_mean_units):
+        return 'mean'
+    return 'sum'
+
+def query_rollup(file_type, timestep, watershed_id, object_id, parameters, periods, stats):
+    values = np.full((len(parameters), len(periods)), np.nan)
+    records = fetch('rollup_' + file_type, watershed_id, int(object_id), list(parameters), timestep,
+                    periods[0].astype('datetime64[D]').item(), periods[-1].astype('datetime64[D]').item())
+
+    # keep only the statistic requested for each variable
+    stat_columns = dict(zip(parameters, [rollup_stat_columns.index(stat) for stat in stats]))
+    records = [(record[0], record[1], record[2 + stat_columns[record[0]]]) for record in records]
+    pivot_records(records, parameters, periods, values)
+    return values
+
+def rollup_series(file_type, timestep, watershed_id, start, end, parameters, object_id, stats):
+    def compute():
+        unit = rollup_periods[timestep][0]
+        days = daily_axis(start, end)
+        periods = np.arange(days[0].astype('datetime64[' + unit + ']'), days[-1].astype('datetime64[' + unit + ']') + 1)
+        return periods, query_rollup(file_type, timestep, watershed_id, object_id, parameters, periods, stats)
+    return cached_series((file_type, timestep, str(object_id), tuple(parameters), start, end, tuple(stats)),
+                         watershed_id, compute)
+
+def extract_rollup(file_type, timestep, watershed, watershed_id, start, end, parameters, object_id, stat=None):
+    label = rollup_periods[timestep][1]
+    stats = [stat or rollup_stat(param) for param in parameters]
+    periods, values = rollup_series(file_type, timestep, watershed_id, start, end, parameters, object_id, stats)
+    times = epoch_ms(periods.astype('datetime64[D]'))
+
+    ts_dict = {'Watershed': watershed,
+               'WatershedID': watershed_id,
+               'Start': start,
+               'End': end,
+               'Stat': stat,
+               'Dates': pd.DatetimeIndex(periods.astype('datetime64[D]')).strftime(label).tolist(),
+               'ReachID': object_id,
                'Parameters': parameters,
                'Values': {},
-               'Names': [],
-               'Timestep': 'Daily',
-               'FileType': 'sub'}
+               'Names': [output_param_names[file_type][param] for param in parameters],
+               'Stats': stats,
+               'Timestep': timestep,
+               'FileType': file_type}
 
-    Session = swatdv.get_persistent_store_database(db['name'], as_sessionmaker=True)
-    session = Session()
     for x in range(0, len(parameters)):
-        param_name = sub_param_names[parameters[x]]
-        subDict['Names'].append(param_name)
+        ts_dict['Values'][x] = series_pairs(times, values[x])
+    return ts_dict
+
+def extract_binary(file_type, timestep, watershed, watershed_id, start, end, parameters, object_id, stat=None):
+    header = {'Watershed': watershed,
+              'ReachID': object_id,
+              'Parameters': parameters,
+              'Names': [output_param_names[file_type][param] for param in parameters],
+              'Timestep': timestep,
+              'FileType': file_type}
+    if timestep in rollup_periods:
+        header['Stats'] = [stat or rollup_stat(param) for param in parameters]
+        axis, values = rollup_series(file_type, timestep, watershed_id, start, end, parameters, object_id,
+                                     header['Stats'])
+    else:
+        axis, values = daily_series(file_type, watershed, watershed_id, start, end, parameters, object_id)
+    return pack_timeseries(header, axis, values)
 
-        sub_qr = """SELECT val FROM output_sub WHERE watershed_id={0} AND sub_id={1} AND var_name='{2}' AND year_month_day BETWEEN '{3}' AND '{4}'; """.format(
-            watershed_id, subid, parameters[x], dt_start, dt_end)
-        data = session.execute(text(sub_qr)).fetchall()
+def extract_monthly_rch(watershed, watershed_id, start, end, parameters, reachid, stat=None):
+    return extract_rollup('rch', 'Monthly', watershed, watershed_id, start, end, parameters, reachid, stat)
 
-        ts = []
-        i = 0
-        while i < len(data):
-            ts.append([daterange_mil[i], data[i][0]])
-            i += 1
+def extract_monthly_sub(watershed, watershed_id, start, end, parameters, subid, stat=None):
+    return extract_rollup('sub', 'Monthly', watershed, watershed_id, start, end, parameters, subid, stat)
 
-        subDict['Values'][x] = ts
-    session.close()
-    return subDict
+def extract_annual_rch(watershed, watershed_id, start, end, parameters, reachid, stat=None):
+    return extract_rollup('rch', 'Annual', watershed, watershed_id, start, end, parameters, reachid, stat)
+
+def extract_annual_sub(watershed, watershed_id, start, end, parameters, subid, stat=None):
+    return extract_rollup('sub', 'Annual', watershed, watershed_id, start, end, parameters, subid, stat)
 
 
 # geospatial processing functions
+river_networks = {}
+
+def river_network(watershed_id):
+    # each watershed's stream_connect table is read once per process (and again after an upload)
+    key = (int(watershed_id), data_version(watershed_id))
+    network = river_networks.get(key)
+    if network is None:
+        records = fetch('stream_connect', watershed_id)
+        network = RiverNetwork([record[0] for record in records], [record[1] for record in records],
+                               [np.nan if record[2] is None else record[2] for record in records])
+        # other request threads may drop the same old versions at the same time
+        for old_key in [old_key for old_key in list(river_networks) if old_key[0] == key[0]]:
+            river_networks.pop(old_key, None)
+        river_networks[key] = network
+    return network
+
 def get_upstreams(watershed_id, streamID):
-    Session = swatdv.get_persistent_store_database(db['name'], as_sessionmaker=True)
-    session = Session()
-    upstreams = [int(streamID)]
-    temp_upstreams = [int(streamID)]
-
-    while len(temp_upstreams)>0:
-        reach = temp_upstreams[0]
-        upstream_qr = """SELECT stream_id FROM stream_connect WHERE watershed_id={0} AND to_node={1}""".format(watershed_id, reach)
-        records = session.execute(text(upstream_qr)).fetchall()
-        for stream in records:
-            temp_upstreams.append(stream[0])
-            upstreams.append(stream[0])
-        temp_upstreams.remove(reach)
-    return upstreams
-
-def clip_raster(watershed, uniqueID, outletID, raster_type):
-    input_json = os.path.join(temp_workspace, uniqueID, 'basin_upstream_' + outletID + '.json')
+    return river_network(watershed_id).upstream(streamID)
+
+def get_downstreams(watershed_id, streamID):
+    return river_network(watershed_id).downstream(streamID)
+
+def get_path(watershed_id, fromID, toID):
+    return river_network(watershed_id).path(fromID, toID)
+
+def upstream_stat(var_name):
+    # yields per hectare are totalled over the upstream area, the subbasin area is summed and depths,
+    # concentrations and storages are area-weighted averages
+    if var_name == 'AREAkm2':
+        return 'total'
+    if var_name.endswith(tuple(upstream_load_units)):
+        return 'total'
+    return 'mean'
+
+def upstream_series(watershed, watershed_id, start, end, parameters, outlets):
+    def compute():
+        network = river_network(watershed_id)
+        if np.isnan(network.areas).any():
+            raise ValueError('subbasin areas are missing for this watershed, upload its stream connectivity again')
+        days = daily_axis(start, end)
+        # every subbasin draining to any of the outlets, fetched in one query
+        sub_ids = sorted(set(sub_id for outlet in outlets for sub_id in network.upstream(outlet)))
+        values = query_series_many('sub', watershed, watershed_id, sub_ids, parameters, days)
+        areas = network.areas[[network.index(sub_id) for sub_id in sub_ids]][:, None, None]
+
+        present = ~np.isnan(values)
+        weighted = network.segment_sums(sub_ids, np.where(present, values, 0) * areas, outlets)
+        covered = network.segment_sums(sub_ids, present * areas, outlets)
+        totals = network.segment_sums(sub_ids, np.where(present, values, 0), outlets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(covered > 0, weighted / covered, np.nan)
+        accumulated = np.empty_like(means)
+        for i, param in enumerate(parameters):
+            if param == 'AREAkm2':
+                accumulated[:, i] = np.where(covered[:, i] > 0, totals[:, i], np.nan)
+            elif upstream_stat(param) == 'total':
+                # yield per ha x area in km2 x 100 ha/km2
+                accumulated[:, i] = np.where(covered[:, i] > 0, weighted[:, i] * 100, np.nan)
+            else:
+                accumulated[:, i] = means[:, i]
+        return days, accumulated
+    return cached_series(('sub', 'Upstream', tuple(str(outlet) for outlet in outlets), tuple(parameters), start, end),
+                         watershed_id, compute)
+
+def upstream_name(param):
+    name = sub_param_names[param]
+    for unit, total_unit in upstream_load_units.items():
+        if param.endswith(unit):
+            return name.replace('(' + unit.replace('t/', 'tons/') + ')', '(' + total_unit + ')')
+    return name
+
+def extract_upstream(watershed, watershed_id, start, end, parameters, outlets):
+    days, values = upstream_series(watershed, watershed_id, start, end, parameters, outlets)
+    network = river_network(watershed_id)
+    return {'Watershed': watershed,
+            'FileType': 'sub',
+            'IDs': outlets,
+            'Parameters': parameters,
+            'Names': [upstream_name(param) for param in parameters],
+            'Stats': [upstream_stat(param) for param in parameters],
+            'Area': network.segment_sums(network.ids, network.areas, outlets).tolist(),
+            'Dates': pd.DatetimeIndex(days).strftime('%b %d, %Y').tolist(),
+            'Times': epoch_ms(days).tolist(),
+            # Values[outlet][parameter][day], aligned with Times; missing values are null
+            'Values': np.where(np.isnan(values), None, values).tolist(),
+            'Timestep': 'Daily'}
+
+def extract_upstream_binary(watershed, watershed_id, start, end, parameters, outlets):
+    days, values = upstream_series(watershed, watershed_id, start, end, parameters, outlets)
+    header = {'Watershed': watershed,
+              'FileType': 'sub',
+              'IDs': outlets,
+              'Parameters': parameters,
+              'Names': [upstream_name(param) for param in parameters],
+              'Stats': [upstream_stat(param) for param in parameters],
+              'Timestep': 'Daily'}
+    # blocks are ordered outlet by outlet, then parameter by parameter
+    return pack_timeseries(header, days, values.reshape(-1, len(days)))
+
+def extract_profile(file_type, watershed, watershed_id, streamID, parameter, date):
+    # value of one variable on one day at every reach of the main stem, outlet first
+    stem = river_network(watershed_id).main_stem(streamID)
+    days = daily_axis(date, date)
+    values = query_series_many(file_type, watershed, watershed_id, stem, [parameter], days)[:, 0, 0]
+    return {'Watershed': watershed,
+            'WatershedID': watershed_id,
+            'FileType': file_type,
+            'Date': date,
+            'Parameter': parameter,
+            'Name': output_param_names[file_type][parameter],
+            'IDs': stem,
+            'Values': np.where(np.isnan(values), None, values).tolist()}
+
+# shapefile zip and geometry type of each upstream feature type
+upstream_shapefiles = {'basin': ('-subbasin.zip', ogr.wkbMultiPolygon),
+                       'reach': ('-reach.zip', ogr.wkbMultiLineString)}
+
+def upstream_features(watershed, feature_type, upstreams):
+    # the upstream subbasins (or reaches) of the uploaded shapefile as (attributes, geometry) pairs in EPSG:4326
+    zip_name, geometry_type = upstream_shapefiles[feature_type]
+    shapefile = ogr.Open('/vsizip/' + os.path.join(data_path, watershed, 'Watershed', watershed + zip_name))
+    layer = shapefile.GetLayer(0)
+
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    source = layer.GetSpatialRef()
+    transform = None
+    if source is not None and not source.IsSame(target):
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(source, target)
+
+    wanted = set(upstreams)
+    features = []
+    for feature in layer:
+        if int(feature.GetField('Subbasin')) in wanted:
+            # the geometry belongs to the feature, so a copy is kept
+            geometry = feature.GetGeometryRef().Clone()
+            if transform is not None:
+                geometry.Transform(transform)
+            features.append((feature.items(), geometry))
+    return features
+
+def dissolve_upstream(feature_type, geometries):
+    # merge upstream subbasins (or reaches) into one geometry, simplified for display and clipping
+    geometry_type = upstream_shapefiles[feature_type][1]
+    merged = ogr.Geometry(geometry_type)
+    for geometry in geometries:
+        # multipart features are added part by part so the collection stays a valid multi geometry
+        if ogr.GT_Flatten(geometry.GetGeometryType()) == ogr.GT_Flatten(geometry_type):
+            for i in range(geometry.GetGeometryCount()):
+                merged.AddGeometry(geometry.GetGeometryRef(i))
+        else:
+            merged.AddGeometry(geometry)
+    if feature_type == 'basin':
+        merged = merged.UnionCascaded()
+    return merged.SimplifyPreserveTopology(upstream_geometry_cache['tolerance'])
+
+def feature_collection(features):
+    # GeoJSON FeatureCollection in EPSG:4326 of (properties, geometry) pairs, with the bounding box of all of them
+    envelopes = np.array([geometry.GetEnvelope() for _, geometry in features]).reshape(-1, 4)
+    bbox = [envelopes[:, 0].min(), envelopes[:, 2].min(), envelopes[:, 1].max(), envelopes[:, 3].max()] \
+        if len(envelopes) > 0 else None
+    return json.dumps({'type': 'FeatureCollection',
+                       'crs': {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:EPSG::4326'}},
+                       'bbox': bbox,
+                       'features': [{'type': 'Feature', 'properties': properties,
+                                     'geometry': json.loads(geometry.ExportToJson())}
+                                    for properties, geometry in features]})
+
+def upstream_geojson_path(watershed, watershed_id, streamID, feature_type):
+    # file with the dissolved geometry upstream of an outlet, used for the map overlay and as the clip cutline. It is
+    # computed once per data version and simplify tolerance and kept on disk for every process
+    cache_dir = upstream_geometry_cache['path']
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    cache_file = os.path.join(cache_dir, '{0}_{1}_{2}_v{3}_t{4}.json'.format(
+        watershed, feature_type, int(streamID), data_version(watershed_id), upstream_geometry_cache['tolerance']))
+    if os.path.exists(cache_file):
+        return cache_file
+
+    upstreams = get_upstreams(watershed_id, streamID)
+    geometry = dissolve_upstream(feature_type, [geometry for _, geometry in
+                                                upstream_features(watershed, feature_type, upstreams)])
+    geojson = feature_collection([({'outletID': int(streamID), 'featureType': feature_type,
+                                    'count': len(upstreams)}, geometry)])
+    # write to a temporary file first so other processes never read a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(geojson)
+    os.replace(tmp_path, cache_file)
+    return cache_file
+
+def upstream_geojson(watershed, watershed_id, streamID, feature_type):
+    with open(upstream_geojson_path(watershed, watershed_id, streamID, feature_type)) as f:
+        return f.read()
+
+def save_upstream_geojson(watershed, watershed_id, unique_id, streamID, feature_type):
+    # the user's copy keeps one feature per subbasin (or reach) with its attributes, as nasaaccess places a station
+    # at every subbasin centroid; it goes in the data cart
+    unique_path = os.path.join(temp_workspace, unique_id)
+    if not os.path.exists(unique_path):
+        os.makedirs(unique_path)
+        os.chmod(unique_path, 0o777)
+    features = upstream_features(watershed, feature_type, get_upstreams(watershed_id, streamID))
+    with open(os.path.join(unique_path, feature_type + '_upstream_' + str(streamID) + '.json'), 'w') as f:
+        f.write(feature_collection(features))
+
+def warp_to_cutline(input_tif, cutline, output_tif, progress=None):
+    # clip a raster to a cutline polygon in process. Cropping to the cutline limits the warp to the source blocks
+    # under the cutline's bounding box. Every call warps straight to its own temporary file next to output_tif, which
+    # replaces output_tif once complete, so concurrent requests never share a dataset or hold the result in memory
+    tmp_path = '{0}.{1}.tmp'.format(output_tif, uuid.uuid4().hex)
+    gdal.SetThreadLocalConfigOption('GDALWARP_IGNORE_BAD_CUTLINE', 'YES')
+    try:
+        # progress(fraction) is called as the warp advances; GDAL continues while the callback returns 1
+        callback = (lambda complete, message, data: progress(complete) or 1) if progress else None
+        options = gdal.WarpOptions(format='GTiff', cutlineDSName=cutline, cropToCutline=True, dstAlpha=True,
+                                   creationOptions=['TILED=YES', 'COMPRESS=DEFLATE'], callback=callback)
+        ds = gdal.Warp(tmp_path, input_tif, options=options)
+        if ds is None:
+            raise IOError('clipping {0} failed: {1}'.format(input_tif, gdal.GetLastErrorMsg()))
+        ds = None  # closing the dataset flushes it to disk
+        os.replace(tmp_path, output_tif)
+    finally:
+        gdal.SetThreadLocalConfigOption('GDALWARP_IGNORE_BAD_CUTLINE', None)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def read_vsimem(mem_path):
+    # the bytes of a /vsimem file
+    f = gdal.VSIFOpenL(mem_path, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    return data
+
+clip_files = FileCache(clip_cache['path'], clip_cache['max_bytes'], '.tif')
+
+def clip_key(watershed, watershed_id, outletID, raster_type):
+    # the clip cache key and the Land raster and cutline it is made from
     input_tif = os.path.join(data_path, watershed, 'Land', raster_type + '.tif')
-    output_tif = os.path.join(temp_workspace, uniqueID, watershed + '_upstream_'+ raster_type + '_' + outletID + '.tif')
-
-    subprocess.call('{0} --config GDALWARP_IGNORE_BAD_CUTLINE YES -cutline {1} -crop_to_cutline -dstalpha {2} {3}'.format(gdalwarp_path,input_json, input_tif, output_tif),shell=True)
-
-    storename = watershed + '_upstream_' + raster_type + '_' + outletID
-    headers = {'Content-type': 'image/tiff', }
-    user = geoserver['user']
-    password = geoserver['password']
-    data = open(output_tif, 'rb').read()
+    cutline = upstream_geojson_path(watershed, watershed_id, outletID, 'basin')
+    return (watershed, str(outletID), raster_type, file_checksum(input_tif), os.path.basename(cutline)), input_tif, \
+        cutline
+
+def clipped_raster(watershed, watershed_id, outletID, raster_type, progress=None):
+    # path of the shared clip of a Land raster to an outlet's dissolved upstream area. Every user who picks the outlet
+    # gets the same file, and concurrent requests for it wait for a single warp
+    key, input_tif, cutline = clip_key(watershed, watershed_id, outletID, raster_type)
+    def create(path):
+        warp_to_cutline(input_tif, cutline, path, progress)
+        build_overviews(path)
+    return clip_files.get_or_create(key, create)
+
+def build_overviews(path, min_size=256):
+    # nearest-neighbour overviews down to about one tile, so low-zoom tiles read a small overview of the clip
+    ds = gdal.Open(path, gdal.GA_Update)
+    factors = []
+    factor = 2
+    while max(ds.RasterXSize, ds.RasterYSize) / factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    if factors:
+        ds.BuildOverviews('NEAREST', factors)
+    ds = None
+
+def link_or_copy(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
 
-    geoserver_engine = get_spatial_dataset_engine(name='ADPC')
-    response = geoserver_engine.get_layer(storename, debug=True)
-    if response['success'] == False:
-        request_url = '{0}workspaces/{1}/coveragestores/{2}/file.geotiff'.format(geoserver['rest_url'],
-                                                                                 geoserver['workspace'], storename)
+def clip_raster(watershed, watershed_id, uniqueID, outletID, raster_type, progress=None):
+    output_tif = os.path.join(temp_workspace, uniqueID, watershed + '_upstream_'+ raster_type + '_' + outletID + '.tif')
 
-        requests.put(request_url, verify=False, headers=headers, data=data, auth=(user, password))
+    clip_path = clipped_raster(watershed, watershed_id, outletID, raster_type, progress)
+    # the user's copy for the data cart is a hard link to the shared clip where the filesystem allows it. The clip is
+    # shown through clip_tile rather than published to GeoServer
+    link_or_copy(clip_path, output_tif)
+    return watershed + '_upstream_' + raster_type + '_' + outletID, clip_path
+
+clip_queue = JobQueue(clip_jobs['path'], clip_jobs['workers'], clip_jobs['max_age'])
+
+def clip_job(progress, watershed, watershed_id, uniqueID, outletID, raster_type):
+    last = [0.0]
+    def warp_progress(fraction):
+        # the warp is most of the job; status files are only rewritten every 5%
+        if fraction * 0.9 - last[0] >= 0.05:
+            last[0] = fraction * 0.9
+            progress(last[0], 'clipping')
+    progress(0.0, 'clipping')
+    storename, clip_path = clip_raster(watershed, watershed_id, uniqueID, outletID, raster_type, warp_progress)
+    # the clip's id in the clip cache is what clip_tile draws it from
+    return {'layer': storename, 'clip': os.path.basename(clip_path)[:-len(clip_files.suffix)]}
+
+def submit_clip(watershed, watershed_id, uniqueID, outletID, raster_type):
+    # returns at once with the id of the background job that clips the raster
+    return clip_queue.submit((watershed, uniqueID, str(outletID), raster_type), clip_job, watershed, watershed_id,
+                             uniqueID, str(outletID), raster_type, watershed=watershed, raster_type=raster_type,
+                             outletID=str(outletID))
+
+coverage_keys = {}
+
+def coverage_key(watershed_id, raster_type):
+    # the {lulc or soil} key table as arrays sorted by raster value, read once per process and data version
+    cache_key = (int(watershed_id), raster_type, data_version(watershed_id))
+    key = coverage_keys.get(cache_key)
+    if key is None:
+        columns = [np.array(column, dtype=object) for column in zip(*sorted(fetch(raster_type + '_key', watershed_id)))]
+        if raster_type == 'lulc':
+            key = {'values': columns[0].astype(np.int64), 'classes': columns[2], 'subclasses': columns[3],
+                   'class_colors': columns[4], 'subclass_colors': columns[5]}
+        else:
+            # soil type is only divided into soil types and does not have subcategories like lulc
+            key = {'values': columns[0].astype(np.int64), 'classes': columns[1], 'class_colors': columns[2]}
+        key['nodata'] = key['classes'] == 'NoData'
+        # rgba palettes for rendering tiles, indexed like key_index with a transparent last row for unknown values
+        for color in ('class', 'subclass'):
+            if color + '_colors' in key:
+                palette = np.zeros((len(key['values']) + 1, 4), dtype=np.uint8)
+                palette[:-1] = [color_rgba(value) for value in key[color + '_colors']]
+                palette[:-1][key['nodata']] = 0
+                key[color + '_palette'] = palette
+        coverage_keys[cache_key] = key
+    return key
+
+def color_rgba(color):
+    # '#rrggbb', '#rgb' or 'rgb(r, g, b)' as an opaque rgba tuple; anything else is transparent
+    color = str(color).strip().lower()
+    if color.startswith('#') and len(color) in (4, 7):
+        digits = color[1:] if len(color) == 7 else ''.join(c * 2 for c in color[1:])
+        try:
+            return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4)) + (255,)
+        except ValueError:
+            return (0, 0, 0, 0)
+    match = re.match(r'rgba?\((\d+),\s*(\d+),\s*(\d+)', color)
+    if match:
+        return tuple(min(int(c), 255) for c in match.groups()) + (255,)
+    return (0, 0, 0, 0)
+
+def key_index(key, values):
+    # position of each raster value in the key; values missing from the key get len(key['values'])
+    values = np.asarray(values, dtype=np.int64)
+    index = np.minimum(np.searchsorted(key['values'], values), len(key['values']) - 1)
+    return np.where(key['values'][index] == values, index, len(key['values']))
+
+def raster_counts(tif_path, key, block_pixels=4194304):
+    # pixel count of each key entry in a clipped raster, read in strips of whole blocks so memory stays flat for
+    # rasters of any size; pixels outside the cutline (alpha 0) are not counted
+    ds = gdal.Open(tif_path)
+    band = ds.GetRasterBand(1)
+    alpha = ds.GetRasterBand(ds.RasterCount)
+    if ds.RasterCount < 2 or alpha.GetColorInterpretation() != gdal.GCI_AlphaBand:
+        alpha = None
+    block_rows = band.GetBlockSize()[1]
+    rows = max(block_rows, block_pixels // max(ds.RasterXSize, 1) // block_rows * block_rows)
+
+    counts = np.zeros(len(key['values']) + 1, dtype=np.int64)
+    for row in range(0, ds.RasterYSize, rows):
+        strip = min(rows, ds.RasterYSize - row)
+        values = band.ReadAsArray(0, row, ds.RasterXSize, strip).ravel()
+        if alpha is not None:
+            values = values[alpha.ReadAsArray(0, row, ds.RasterXSize, strip).ravel() > 0]
+        counts += np.bincount(key_index(key, values), minlength=len(counts))
+    return counts[:-1]
+
+def coverage_counts(watershed, watershed_id, unique_id, outletID, raster_type, key):
+    # pixel count of each key entry upstream of the outlet: the sum of the per-subbasin histograms stored at upload,
+    # or for watersheds uploaded without histograms a count over the outlet's clip. None if that clip has not been
+    # made yet; the request never waits for a warp
+    records = fetch('coverage_histogram', watershed_id, raster_type, get_upstreams(watershed_id, outletID))
+    if len(records) > 0:
+        counts = np.zeros(len(key['values']) + 1, dtype=np.int64)
+        values, pixels = zip(*records)
+        np.add.at(counts, key_index(key, values), np.asarray(pixels, dtype=np.int64))
+        return counts[:-1]
+
+    clip_path = clip_files.get(clip_key(watershed, watershed_id, outletID, raster_type)[0])
+    if clip_path is None:
+        return None
+    return raster_counts(clip_path, key)
+
+def group_percents(names, colors, percents):
+    # total percent and colour of each distinct class or subclass name
+    unique, first, inverse = np.unique(names.astype(str), return_index=True, return_inverse=True)
+    totals = np.bincount(inverse, weights=percents, minlength=len(unique))
+    return dict(zip(unique.tolist(), totals.tolist())), dict(zip(unique.tolist(), colors[first].tolist()))
 
 def coverage_stats(watershed, watershed_id, unique_id, outletID, raster_type):
-    Session = swatdv.get_persistent_store_database(db['name'], as_sessionmaker=True)
-    session = Session()
-    tif_path = temp_workspace + '/' + str(unique_id) + '/' + watershed + '_upstream_' + str(raster_type) + '_' + str(
-        outletID) + '.tif'
-    ds = gdal.Open(tif_path)  # open user-requested TIFF file using gdal
-    band = ds.GetRasterBand(1)  # read the 1st raster band
-    array = np.array(band.ReadAsArray())  # create an array of all values in the raster
-    size = array.size  # get the size (pixel count) of the raster
-    unique, counts = np.unique(array, return_counts=True)  # find all the unique values in the raster
-    unique_dict = dict(
-        zip(unique, counts))  # create a dictionary containing unique values and the number of times each occurs
-    # get "NoData" values from the {lulc or soil} Postgres table
-    nodata_values = []
-    nodata_qr = """SELECT value FROM {0} WHERE watershed_id={1} AND {0}_class='NoData'""".format(raster_type, watershed_id)
-    records = session.execute(text(nodata_qr)).fetchall()
-    for val in records:
-        nodata_values.append(val[0])
-
-    # subtract the count of "No Data" pixels in the raster from the total raster size
-    for x in unique_dict:
-        if x in nodata_values:
-            nodata_size = unique_dict[x]
-            size = size - nodata_size
-            unique_dict[x] = 0
-
-    # compute percent coverage for each unique value
-    for x in unique_dict:
-        if x not in nodata_values:
-            unique_dict[x] = float(unique_dict[x]) / size * 100
-
-    # create dictionary containing all the coverage information from the raster and info.txt file
+    key = coverage_key(watershed_id, raster_type)
+    counts = coverage_counts(watershed, watershed_id, unique_id, outletID, raster_type, key)
+    if counts is None:
+        return None
+
+    # percent coverage of each key entry, leaving "No Data" pixels out of the total
+    size = counts[~key['nodata']].sum()
+    present = np.flatnonzero((counts > 0) & ~key['nodata'])
+    percents = counts[present] * (100.0 / size) if size > 0 else np.zeros(len(present))
+
+    # create dictionary containing all the coverage information from the raster and key table
+    class_values, class_colors = group_percents(key['classes'][present], key['class_colors'][present], percents)
     if raster_type == 'lulc':
-
         # lulc is divided into classes and subclasses for easier categorizing and visualization
-        lulc_dict = {'classes': {}, 'classValues': {}, 'classColors': {}, 'subclassValues': {}, 'subclassColors': {}}
-
-        for val in unique_dict:
-            lulc_qr = """SELECT * FROM {0} WHERE watershed_id={1} AND value={2}""".format(raster_type, watershed_id, val)
-            records = session.execute(text(lulc_qr)).fetchall()
-            record = records[0]
-            if str(val) not in nodata_values:
-                lulc_dict['subclassColors'][record[5]] = record[7]
-                lulc_dict['subclassValues'][record[5]] = unique_dict[val]
-                lulc_dict['classes'][record[5]] = record[4]
-                if record[4] not in lulc_dict['classValues'].keys():
-                    lulc_dict['classValues'][record[4]] = unique_dict[val]
-                    lulc_dict['classColors'][record[4]] = record[6]
-                else:
-                    # add all the % coverage values within a class together
-                    lulc_dict['classValues'][record[4]] += unique_dict[val]
-        return (lulc_dict)
+        subclass_values, subclass_colors = group_percents(key['subclasses'][present],
+                                                          key['subclass_colors'][present], percents)
+        return {'classes': dict(zip(key['subclasses'][present].astype(str).tolist(),
+                                    key['classes'][present].astype(str).tolist())),
+                'classValues': class_values, 'classColors': class_colors,
+                'subclassValues': subclass_values, 'subclassColors': subclass_colors}
 
     if raster_type == 'soil':
-        # soil type is only divided into soil types and does not have subcategories like lulc
-        soil_dict = {'classValues': {}, 'classColors': {}}
-
-        for val in unique_dict:
-            soil_qr = """SELECT * FROM {0} WHERE watershed_id={1} AND value={2}""".format(raster_type, watershed_id, val)
-            records = session.execute(text(soil_qr)).fetchall()
-            record = records[0]
-            if str(val) not in nodata_values:
-                soil_dict['classColors'][record[3]] = record[4]
-                soil_dict['classValues'][record[3]] = unique_dict[val]
-        return (soil_dict)
-
+        return {'classValues': class_values, 'classColors': class_colors}
+
+# XYZ tiles of clipped rasters, rendered in the app so per-user clips never become GeoServer stores
+tile_size = 256
+mercator_extent = 20037508.342789244
+tile_cache = MemoryCache(clip_tiles['max_bytes'])
+
+def tile_bounds(z, x, y):
+    # web mercator bounds (minx, miny, maxx, maxy) of an XYZ tile
+    size = 2 * mercator_extent / 2 ** z
+    minx = -mercator_extent + x * size
+    maxy = mercator_extent - y * size
+    return minx, maxy - size, minx + size, maxy
+
+def mercator_bounds(ds, samples=21):
+    # web mercator bounds of a dataset, from points along its edges so curved edges are covered too
+    gt = ds.GetGeoTransform()
+    steps = np.linspace(0, 1, samples)
+    columns = np.r_[steps, steps, np.zeros(samples), np.ones(samples)] * ds.RasterXSize
+    rows = np.r_[np.zeros(samples), np.ones(samples), steps, steps] * ds.RasterYSize
+    xs = gt[0] + columns * gt[1] + rows * gt[2]
+    ys = gt[3] + columns * gt[4] + rows * gt[5]
+
+    source = osr.SpatialReference(wkt=ds.GetProjection())
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(3857)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    points = np.array(osr.CoordinateTransformation(source, target).TransformPoints(
+        list(zip(xs.tolist(), ys.tolist()))))
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+def tile_source(watershed_id, clip, raster_type, color):
+    # path, key, palette and web mercator bounds of a clip, looked up once per clip and colour rather than per tile;
+    # None once the clip has been evicted from the clip cache
+    clip_path = os.path.join(clip_files.path, clip + clip_files.suffix)
+    source = tile_cache.get(('source', clip, color))
+    if source is None:
+        if not os.path.exists(clip_path):
+            return None
+        key = coverage_key(watershed_id, raster_type)
+        source = {'path': clip_path, 'key': key, 'palette': key.get(color + '_palette', key['class_palette']),
+                  'bounds': mercator_bounds(gdal.Open(clip_path))}
+        tile_cache.put(('source', clip, color), source, source['palette'].nbytes + 1024)
+    return source
+
+def encode_png(rgba):
+    # PNG bytes of an rgba array
+    image = gdal.GetDriverByName('MEM').Create('', rgba.shape[1], rgba.shape[0], 4, gdal.GDT_Byte)
+    for band in range(4):
+        image.GetRasterBand(band + 1).WriteArray(rgba[:, :, band])
+    mem_path = '/vsimem/tile_{0}.png'.format(uuid.uuid4().hex)
+    try:
+        gdal.GetDriverByName('PNG').CreateCopy(mem_path, image)
+        return read_vsimem(mem_path)
+    finally:
+        gdal.Unlink(mem_path)
+
+def empty_tile():
+    png = tile_cache.get('empty')
+    if png is None:
+        png = encode_png(np.zeros((tile_size, tile_size, 4), dtype=np.uint8))
+        tile_cache.put('empty', png, len(png))
+    return png
+
+def render_tile(watershed_id, clip, raster_type, color, z, x, y):
+    """
+    PNG of one tile of a clipped raster, coloured from the key table's class or subclass colours. clip is the id the
+    clip job returned, so a cached tile costs no query or file access. Raises ValueError for an invalid request and
+    returns None for a clip that is no longer cached
+    """
+    if raster_type not in ('lulc', 'soil') or color not in ('class', 'subclass'):
+        raise ValueError('unknown raster type or colour')
+    if not re.match('^[0-9a-f]{40}$', str(clip)) or not 0 <= z <= 24 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError('invalid tile')
+    cache_key = (clip, color, z, x, y)
+    png = tile_cache.get(cache_key)
+    if png is not None:
+        return png
+
+    source = tile_source(watershed_id, clip, raster_type, color)
+    if source is None:
+        return None
+    bounds = tile_bounds(z, x, y)
+    extent = source['bounds']
+    if bounds[0] >= extent[2] or bounds[2] <= extent[0] or bounds[1] >= extent[3] or bounds[3] <= extent[1]:
+        return empty_tile()
+    clip_files.touch(source['path'])
+
+    # nearest-neighbour warp of the tile's extent so raster values stay key values; at low zooms GDAL reads the
+    # clip's overviews instead of the full raster
+    ds = gdal.Warp('', source['path'], format='MEM', dstSRS='EPSG:3857', outputBounds=bounds,
+                   width=tile_size, height=tile_size, resampleAlg='near')
+    values = ds.GetRasterBand(1).ReadAsArray()
+    key = source['key']
+    rgba = source['palette'][key_index(key, values.ravel())].reshape(tile_size, tile_size, 4)
+    if ds.RasterCount > 1:
+        # pixels outside the cutline or the raster (alpha 0) are transparent
+        rgba[ds.GetRasterBand(ds.RasterCount).ReadAsArray() == 0] = 0
+    ds = None
+
+    png = encode_png(rgba)
+    tile_cache.put(cache_key, png, len(png))
+    return png
 
 #nasaaccess function
 def nasaaccess_run(userId, streamId, email, functions, watershed, start, end):
@@ -415,74 +1253,59 @@ def nasaaccess_run(userId, streamId, email, functions, watershed, start, end):
 
 
 # data writing functions
-def write_csv(data):
-
-    watershed = data['Watershed']
-    watershed = watershed.replace('_', '')
+csv_formats = {'Daily': ('Date (m/d/y)', '%-m/%d/%Y', '%m%d%Y'),
+               'Monthly': ('Date (m/y)', '%-m/%Y', '%m%Y'),
+               'Annual': ('Year', '%Y', '%Y')}
 
-    streamID = data['ReachID']
+# days of daily data read from the series store per csv chunk
+csv_chunk_days = 365
 
-    parameters = data['Parameters']
+def csv_file_info(watershed, file_type, timestep, start, end, parameters, streamID):
     param_str = '&'.join(parameters)
     param_str_low = ''.join(param_str.lower().split('_')).replace('/','')
+    file_format = csv_formats[timestep][2]
+    start = datetime.strptime(start, '%B %d, %Y').strftime(file_format)
+    end = datetime.strptime(end, '%B %d, %Y').strftime(file_format)
 
-    timestep = data['Timestep']
-    dates = data['Dates']
-    values = data['Values']
-    file_type = data['FileType']
-    unique_id = data['userId']
-
-    start = ''
-    end = ''
-
-    if timestep == 'Monthly':
-        start = datetime.strptime(dates[0], '%b %y').strftime('%m%Y')
-        end = datetime.strptime(dates[-1], '%b %y').strftime('%m%Y')
-    elif timestep == 'Daily':
-        start = datetime.strptime(dates[0], '%b %d, %Y').strftime('%m%d%Y')
-        end = datetime.strptime(dates[-1], '%b %d, %Y').strftime('%m%d%Y')
-
-    file_name = watershed + '_' + file_type + streamID + '_' + param_str_low + '_' + start + 'to' + end
-    file_name.replace('/','')
+    file_name = watershed.replace('_', '') + '_' + file_type + streamID + '_' + param_str_low + '_' + start + 'to' + end
     file_dict = {'Parameters': param_str,
                  'Start': start,
                  'End': end,
                  'FileType': file_type,
                  'TimeStep': timestep,
                  'StreamID': streamID}
+    return file_name, file_dict
+
+def csv_chunk(axis, values, timestep):
+    frame = pd.DataFrame(values.T)
+    frame.insert(0, 'date', pd.DatetimeIndex(axis.astype('datetime64[D]')).strftime(csv_formats[timestep][1]))
+    frame.insert(0, 'utc', epoch_ms(axis.astype('datetime64[D]')) // 1000)
+    return frame.to_csv(index=False, header=False)
+
+def csv_rows(file_type, timestep, watershed, watershed_id, start, end, parameters, object_id, stat=None):
+    # csv text read from the series store a chunk at a time, so memory stays flat for any range or variable count
+    yield ','.join(['UTC Offset (sec)', csv_formats[timestep][0]] + list(parameters)) + '\n'
+    if timestep in rollup_periods:
+        stats = [stat or rollup_stat(param) for param in parameters]
+        periods, values = rollup_series(file_type, timestep, watershed_id, start, end, parameters, object_id, stats)
+        yield csv_chunk(periods, values, timestep)
+    else:
+        days = daily_axis(start, end)
+        for first in range(0, len(days), csv_chunk_days):
+            chunk = days[first:first + csv_chunk_days]
+            values = query_series(file_type, watershed, watershed_id, object_id, parameters, chunk)
+            yield csv_chunk(chunk, values, timestep)
 
-    csv_path = os.path.join(temp_workspace, unique_id, file_name + '.csv')
-
-    fieldnames = []
-    if timestep == 'Monthly':
-        fieldnames = ['UTC Offset (sec)', 'Date (m/y)']
-    elif timestep == 'Daily':
-        fieldnames = ['UTC Offset (sec)', 'Date (m/d/y)']
-
-    fieldnames.extend(parameters)
-
-    utc_list = []
-    date_list = []
-    for i in range(0, len(dates)):
-        utc_list.append(values['0'][i][0]/1000)
-        if timestep == 'Monthly':
-            date_list.append(datetime.strptime(dates[i], '%b %y').strftime('%-m/%Y'))
-        elif timestep == 'Daily':
-            date_list.append(datetime.strptime(dates[i], '%b %d, %Y').strftime('%-m/%d/%Y'))
-    d = OrderedDict()
-    d[fieldnames[0]] = utc_list
-    d[fieldnames[1]] = date_list
-
-    for j in range(0, len(parameters)):
-        value_list = []
-        param = parameters[j]
-        for i in range(0, len(dates)):
-            value_list.append(values[str(j)][i][1])
-        d[param] = value_list
-
-    df = pd.DataFrame(data=d)
-
-    df.to_csv(csv_path, sep=',', index=False)
+def write_csv(data):
+    # the data cart only posts what was requested; the values are read again from the series store
+    file_name, file_dict = csv_file_info(data['Watershed'], data['FileType'], data['Timestep'], data['Start'],
+                                         data['End'], data['Parameters'], data['ReachID'])
+    csv_path = os.path.join(temp_workspace, data['userId'], file_name + '.csv')
+
+    with open(csv_path, 'w') as f:
+        for chunk in csv_rows(data['FileType'], data['Timestep'], data['Watershed'], data['WatershedID'],
+                              data['Start'], data['End'], data['Parameters'], data['ReachID'], data.get('Stat')):
+            f.write(chunk)
     return file_dict
 
 def zipfolder(zip_name, data_dir):
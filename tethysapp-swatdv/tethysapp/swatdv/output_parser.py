@@ -0,0 +1,68 @@
+import io
+import numpy as np
+import pandas as pd
+
+# labels in front of every data line, which SWAT glues to the id once the id needs the room (BIGSUB1234). BIGSUB
+# comes before SUB so it is removed whole
+labels = (b'BIGSUB', b'REACH', b'SUB')
+
+
+def skip_header(f):
+    # move f past the header; the last header line is the one naming the columns
+    for line in f:
+        if b'AREAkm2' in line:
+            return
+    raise ValueError('no column header found in ' + f.name)
+
+
+def read_chunks(file_path, chunk_bytes):
+    # blocks of whole data lines of about chunk_bytes each, with the label column removed. Replacing the labels with
+    # whitespace splits glued ids off without looking at the lines one by one
+    with open(file_path, 'rb') as f:
+        skip_header(f)
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                return
+            block += f.readline()
+            for label in labels:
+                block = block.replace(label, b' ')
+            yield block
+
+
+def parse_output_file(file_path, column_list, file_vars, chunk_bytes=64 * 1024 * 1024):
+    '''
+    Parse a SWAT output file in large chunks and yield (ids, dates, values) arrays per chunk: the reach or subbasin
+    id and date (datetime64[D]) of every line, and values[i] holding file_vars[i] for every line.
+    column_list names the file's columns as in outputs_config, with the label column first.
+    '''
+    # positions after the label column is removed
+    id_column, month, day, year = [column_list.index(name) - 1 for name in (column_list[1], 'MO', 'DA', 'YR')]
+    var_columns = [column_list.index(name) - 1 for name in file_vars]
+    usecols = sorted(set([id_column, month, day, year] + var_columns))
+
+    for block in read_chunks(file_path, chunk_bytes):
+        if not block.strip():
+            continue
+        frame = pd.read_csv(io.BytesIO(block), sep=r'\s+', header=None, usecols=usecols, engine='c')
+        ids = frame[id_column].to_numpy(dtype=np.int64)
+        dates = ((frame[year].to_numpy() - 1970).astype('datetime64[Y]') +
+                 (frame[month].to_numpy() - 1).astype('timedelta64[M]')).astype('datetime64[D]') + \
+                (frame[day].to_numpy() - 1).astype('timedelta64[D]')
+        values = np.empty((len(var_columns), len(frame)), dtype=np.float64)
+        for i, column in enumerate(var_columns):
+            values[i] = frame[column].to_numpy(dtype=np.float64)
+        yield ids, dates, values
+
+
+def output_extent(file_path, column_list):
+    # the sorted reach or subbasin ids in a file and its first and last dates
+    ids = []
+    start = end = None
+    for chunk_ids, dates, _ in parse_output_file(file_path, column_list, []):
+        ids.append(np.unique(chunk_ids))
+        start = dates.min() if start is None else min(start, dates.min())
+        end = dates.max() if end is None else max(end, dates.max())
+    if not ids:
+        return np.array([], dtype=np.int64), None, None
+    return np.unique(np.concatenate(ids)), start, end
@@ -44,4 +44,25 @@ sub_param_names = {'':'', 'SUB':'Subbasin', 'GIS':'GIS',  'MO':'Month', 'DA':'Da
                'LATNO3kg/ha': 'Nitrate in Lateral Flow (kg/ha)', 'GWNO3kg/ha':'Nitrate Loading in Groundwater (kg/ha)',
                'CHOLAmic/L':'Chloraphyll-a Loading (mic/L)', 'CBODUmg/L':'Carbonaceous BOD Loading (mg/L)',
                'DOXQmg/L': 'Dissolved Oxygen Loading (mg/L)', 'TNO3kg/ha': 'Nitrate in Tile Flow (kg/ha)'
-               }
\ No newline at end of file
+               }
+
+# list of variables in SWAT output files used to index columns; a variable's position in its list is also its var_id
+sub_column_list = ['', 'SUB', 'GIS', 'MO', 'DA', 'YR', 'AREAkm2', 'PRECIPmm', 'SNOMELTmm', 'PETmm', 'ETmm',
+                   'SWmm', 'PERCmm', 'SURQmm', 'GW_Qmm', 'WYLDmm', 'SYLDt/ha', 'ORGNkg/ha', 'ORGPkg/ha',
+                   'NSURQkg/ha', 'SOLPkg/ha', 'SEDPkg/ha', 'LATQmm', 'LATNO3kg/ha', 'GWNO3kg/ha', 'CHOLAmic/L',
+                   'CBODUmg/L', 'DOXQmg/L', 'TNO3kg/ha']
+rch_column_list = ['', 'RCH', 'GIS', 'MO', 'DA', 'YR', 'AREAkm2', 'FLOW_INcms', 'FLOW_OUTcms', 'EVAPcms', 'TLOSScms',
+                   'SED_INtons', 'SED_OUTtons', 'SEDCONCmg/kg', 'ORGN_INkg', 'ORGN_OUTkg', 'ORGP_INkg', 'ORGP_OUTkg',
+                   'NO3_INkg','NO3_OUTkg', 'NH4_INkg', 'NH4_OUTkg', 'NO2_INkg', 'NO2_OUTkg', 'MINP_INkg', 'MINP_OUTkg',
+                   'SOLPST_OUTmg', 'SORPST_INmg', 'SORPST_OUTmg', 'REACTPSTmg', 'VOLPSTmg', 'SETTLPSTmg', 'RESUSP_PSTmg',
+                   'DIFFUSEPSTmg', 'REACBEDPSTmg', 'BURYPSTmg', 'BED_PSTmg', 'BACTP_OUTct', 'BACTLP_OUTct', 'CMETAL#1kg',
+                   'CMETAL#2kg', 'CMETAL#3kg', 'TOTNkg', 'TOTPkg', 'NO3ConcMg/l', 'WTMPdegc']
+
+# units of variables that are averaged (rather than summed) when rolled up to monthly or annual values
+rollup_mean_units = ('cms', 'mg/kg', 'mic/L', 'mg/L', 'Mg/l', 'degc', 'km2')
+# state variables (amounts held at the end of each day, not fluxes) are averaged whatever their units
+rollup_mean_vars = ('SWmm', 'BED_PSTmg')
+
+# units of output.sub yields that are totalled (yield x area) when accumulated over the subbasins upstream of an
+# outlet; other output.sub variables are area-weighted averages over the upstream area
+upstream_load_units = {'kg/ha': 'kg', 't/ha': 'tons'}
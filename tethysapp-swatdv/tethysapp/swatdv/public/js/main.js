@@ -56,9 +56,12 @@ var LIBRARY_OBJECT = (function() {
         download,
         lulc_compute,
         soil_compute,
+        coverage_pending,
         get_upstream,
-        save_json,
+        upstream_geometry,
         clip_rasters,
+        clip_status,
+        clip_tile_url,
         add_streams,
         add_basins,
         add_stations,
@@ -475,12 +478,14 @@ var LIBRARY_OBJECT = (function() {
                             $('#lulc_tab').removeClass('active');
                             if (sessionStorage.lulc_avail === 'Yes') {
                                 $('#clip_lulc').attr('disabled', false)
-                                $('#lulc_compute').attr('disabled', true)
+                                // coverages come from the stored histograms, so they do not wait for the clip
+                                $('#lulc_compute').attr('disabled', false)
                             }
                             $('#soil_tab').removeClass('active');
                             if (sessionStorage.soil_avail === 'Yes') {
                                 $('#clip_soil').attr('disabled', false)
-                                $('#soil_compute').attr('disabled', true)
+                                // coverages come from the stored histograms, so they do not wait for the clip
+                                $('#soil_compute').attr('disabled', false)
                             }
                             $('#nasaaccess_tab').removeClass('active');
                             $('#datacart_tab').removeClass('active');
@@ -529,17 +534,7 @@ var LIBRARY_OBJECT = (function() {
                 var upstreams = data.upstreams
                 var outletID = sessionStorage.streamID
                 sessionStorage.setItem('upstreams', upstreams)
-                var cql_filter
-                if (upstreams.length > 376) {
-                    cql_filter = 'Subbasin=' + streamID.toString();
-                } else {
-                    cql_filter = 'Subbasin=' + streamID.toString();
-                    for (var i=1; i<upstreams.length; i++) {
-                        cql_filter += ' OR Subbasin=' + upstreams[i].toString();
-                    }
-                }
                 var reach_url = geoserver_url + 'ows?service=wfs&version=2.0.0&request=getfeature&typename=' + reach_store_id + '&CQL_FILTER=Subbasin=' + streamID + '&outputFormat=application/json&srsname=EPSG:4326&,EPSG:4326'
-                var upstream_reach_url = geoserver_url + 'ows?service=wfs&version=2.0.0&request=getfeature&typename=' + reach_store_id + '&CQL_FILTER=' + cql_filter+ '&outputFormat=application/json&srsname=EPSG:4326&,EPSG:4326'
 
                 var streamVectorSource = new ol.source.Vector({
                     format: new ol.format.GeoJSON(),
@@ -557,11 +552,8 @@ var LIBRARY_OBJECT = (function() {
                     })
                 });
 
-                var upstreamStreamVectorSource = new ol.source.Vector({
-                    format: new ol.format.GeoJSON(),
-                    url: upstream_reach_url,
-                    strategy: ol.loadingstrategy.bbox
-                });
+                // the upstream reaches and subbasins are dissolved on the server and added once they arrive
+                var upstreamStreamVectorSource = new ol.source.Vector();
 
                 upstreamOverlayStream = new ol.layer.Vector({
                     source: upstreamStreamVectorSource,
@@ -578,12 +570,7 @@ var LIBRARY_OBJECT = (function() {
 
 
                 var basin_url = geoserver_url + 'ows?service=wfs&version=2.0.0&request=getfeature&typename=' + basin_store_id + '&CQL_FILTER=Subbasin=' + streamID + '&outputFormat=application/json&srsname=EPSG:4326&,EPSG:4326'
-                var upstream_basin_url = geoserver_url + 'ows?service=wfs&version=2.0.0&request=getfeature&typename=' + basin_store_id + '&CQL_FILTER=' + cql_filter + '&outputFormat=application/json&srsname=EPSG:4326&,EPSG:4326'
-                var upstreamSubbasinVectorSource = new ol.source.Vector({
-                    format: new ol.format.GeoJSON(),
-                    url: upstream_basin_url,
-                    strategy: ol.loadingstrategy.bbox
-                });
+                var upstreamSubbasinVectorSource = new ol.source.Vector();
 
                 var color = '#ffffff';
                     color = ol.color.asArray(color);
@@ -631,92 +618,48 @@ var LIBRARY_OBJECT = (function() {
                 soil_map.addLayer(upstreamOverlaySubbasin);
                 lulc_map.addLayer(upstreamOverlaySubbasin);
 
-                save_json(upstream_basin_url, upstream_reach_url, data);
+                upstream_geometry('reach', upstreamStreamVectorSource, watershed, watershed_id, streamID, userId);
+                upstream_geometry('basin', upstreamSubbasinVectorSource, watershed, watershed_id, streamID, userId);
 
                 nasaaccess_map.addLayer(upstreamOverlaySubbasin);
             }
         });
     }
 
-    save_json = function(upstream_basin_url, upstream_reach_url, data) {
-        $.getJSON(upstream_reach_url, function(data) {
-            var upstreamJson = data;
-            upstreamJson['uniqueId'] = sessionStorage.userId
-            upstreamJson['featureType'] = 'reach'
-            upstreamJson['outletID'] = sessionStorage.streamID
-            upstreamJson['watershed'] = sessionStorage.watershed
-            $.ajax({
-                type: 'POST',
-                url: "/apps/swatdv/save_json/",
-                data: JSON.stringify(upstreamJson),
-                success: function(result){
-                    var bbox = result.bbox
-                    var srs = result.srs
-                    var new_extent = ol.proj.transformExtent(bbox, srs, 'EPSG:4326');
-                    sessionStorage.setItem('streamExtent', new_extent)
-                    var center = ol.extent.getCenter(new_extent)
-                    var view = new ol.View({
-                        center: center,
-                        projection: 'EPSG:4326',
-                        extent: new_extent,
-                        zoom: 8
-                    });
+    upstream_geometry = function(featureType, source, watershed, watershed_id, streamID, userId) {
+        $.ajax({
+            type: 'POST',
+            url: "/apps/swatdv/upstream_geometry/",
+            data: {
+                'watershed': watershed,
+                'watershed_id': watershed_id,
+                'streamID': streamID,
+                'id': userId,
+                'featureType': featureType
+            },
+            success: function(result){
+                source.addFeatures(new ol.format.GeoJSON().readFeatures(result));
+                var new_extent = result.bbox
 
+                if (featureType == 'reach') {
+                    sessionStorage.setItem('streamExtent', new_extent)
                     rch_map.updateSize();
-                    rch_map.getView().fit(sessionStorage.streamExtent.split(',').map(Number), rch_map.getSize());
-                    sub_map.updateSize();
-                    sub_map.getView().fit(sessionStorage.streamExtent.split(',').map(Number), sub_map.getSize());
-                    lulc_map.updateSize();
-                    lulc_map.getView().fit(sessionStorage.streamExtent.split(',').map(Number), lulc_map.getSize());
-                    soil_map.updateSize();
-                    soil_map.getView().fit(sessionStorage.streamExtent.split(',').map(Number), soil_map.getSize());
-                    nasaaccess_map.updateSize();
-                    nasaaccess_map.getView().fit(sessionStorage.streamExtent.split(',').map(Number), nasaaccess_map.getSize());
-
-
-                    var newrow = '<tr><td>reach_upstream</td><td>JSON</td><td>' + sessionStorage.streamID + '</td></tr>'
-                    $('#tBodySpatial').append(newrow);
-                }
-            })
-        })
-        $.getJSON(upstream_basin_url, function(data) {
-            var upstreamJson = data;
-            upstreamJson['uniqueId'] = sessionStorage.userId
-            upstreamJson['featureType'] = 'basin'
-            upstreamJson['outletID'] = sessionStorage.streamID
-            upstreamJson['watershed'] = sessionStorage.watershed
-            $.ajax({
-                type: 'POST',
-                url: "/apps/swatdv/save_json/",
-                data: JSON.stringify(upstreamJson),
-                success: function(result){
-                    var bbox = result.bbox
-                    var srs = result.srs
-                    var new_extent = ol.proj.transformExtent(bbox, srs, 'EPSG:4326');
+                    rch_map.getView().fit(new_extent, rch_map.getSize());
+                } else {
                     sessionStorage.setItem('basinExtent', new_extent)
-                    var center = ol.extent.getCenter(new_extent)
-                    var view = new ol.View({
-                        center: center,
-                        projection: 'EPSG:4326',
-                        extent: new_extent,
-                        zoom: 8
-                    });
-
-                    sub_map.updateSize();
-                    sub_map.getView().fit(sessionStorage.basinExtent.split(',').map(Number), sub_map.getSize());
-                    lulc_map.updateSize();
-                    lulc_map.getView().fit(sessionStorage.basinExtent.split(',').map(Number), lulc_map.getSize());
-                    soil_map.updateSize();
-                    soil_map.getView().fit(sessionStorage.basinExtent.split(',').map(Number), soil_map.getSize());
-                    nasaaccess_map.updateSize();
-                    nasaaccess_map.getView().fit(sessionStorage.basinExtent.split(',').map(Number), nasaaccess_map.getSize());
-
-
-                    var newrow = '<tr><td>basin_upstream</td><td>JSON</td><td>' + sessionStorage.streamID + '</td></tr>'
-                    $('#tBodySpatial').append(newrow);
-
                 }
-            })
+                sub_map.updateSize();
+                sub_map.getView().fit(new_extent, sub_map.getSize());
+                lulc_map.updateSize();
+                lulc_map.getView().fit(new_extent, lulc_map.getSize());
+                soil_map.updateSize();
+                soil_map.getView().fit(new_extent, soil_map.getSize());
+                nasaaccess_map.updateSize();
+                nasaaccess_map.getView().fit(new_extent, nasaaccess_map.getSize());
+
+                var newrow = '<tr><td>' + featureType + '_upstream</td><td>JSON</td><td>' + sessionStorage.streamID + '</td></tr>'
+                $('#tBodySpatial').append(newrow);
+            }
         })
     }
 
@@ -735,28 +678,58 @@ var LIBRARY_OBJECT = (function() {
             url: '/apps/swatdv/clip_rasters/',
             data: {
                 'watershed': watershed,
+                'watershed_id': sessionStorage.watershed_id,
                 'userId': userId,
                 'outletID': outletID,
                 'raster_type': raster_type
             },
             success: function(data) {
+                // the clip runs as a background job on the server; poll it until the layer is published
+                clip_status(data.job_id, watershed, outletID, raster_type)
+            }
+        })
+    }
+
+    clip_tile_url = function(clip, raster_type, color) {
+        // ol.source.XYZ fills in {z}, {x} and {y}; clip is the id the clip job returned
+        return '/apps/swatdv/clip_tile/?' + $.param({
+            'watershed_id': sessionStorage.watershed_id,
+            'clip': clip,
+            'raster_type': raster_type,
+            'color': color
+        }) + '&z={z}&x={x}&y={y}'
+    }
+
+    clip_status = function(job_id, watershed, outletID, raster_type) {
+        $.ajax({
+            type: "GET",
+            url: '/apps/swatdv/clip_status/',
+            data: {
+                'job_id': job_id
+            },
+            success: function(data) {
+                if (data.status == 'failed') {
+                    $('#' + raster_type + '-loading').addClass('hidden')
+                    alert('Clipping the ' + raster_type + ' raster failed: ' + data.error)
+                    return
+                }
+                if (data.status != 'done') {
+                    setTimeout(function() {
+                        clip_status(job_id, watershed, outletID, raster_type)
+                    }, 1000)
+                    return
+                }
                 if (data.raster_type == 'lulc') {
                     lulc_map.removeLayer(upstreamOverlaySubbasin)
                     $('#clip_lulc').attr("disabled", true)
-                    $('#lulc_compute').attr("disabled", false)
-                    var lulc_store = watershed + '_upstream_lulc_' + outletID
-                    var lulc_store_id = gs_workspace + ':' + lulc_store
-                    var style = watershed + '-' + data.raster_type
-
-                    //     Set the wms source to the url, workspace, and store for the subbasins of the selected watershed
-                    var lulc_wms_source = new ol.source.ImageWMS({
-                        url: geoserver_url,
-                        params: {'LAYERS':lulc_store_id, 'STYLES':style},
-                        serverType: 'geoserver',
+
+                    //     The clipped raster is rendered by the app as XYZ tiles instead of a GeoServer layer
+                    var lulc_tile_source = new ol.source.XYZ({
+                        url: clip_tile_url(data.clip, 'lulc', 'subclass'),
                         crossOrigin: 'Anonymous'
                     });
-                    upstream_lulc = new ol.layer.Image({
-                        source: lulc_wms_source
+                    upstream_lulc = new ol.layer.Tile({
+                        source: lulc_tile_source
                     });
                     $('#lulc-loading').addClass('hidden')
                     lulc_map.addLayer(upstream_lulc);
@@ -767,21 +740,15 @@ var LIBRARY_OBJECT = (function() {
                 if (data.raster_type == 'soil') {
                     soil_map.removeLayer(upstreamOverlaySubbasin)
                     $('#clip_soil').attr("disabled", true)
-                    $('#soil_compute').attr("disabled", false)
-                    var soil_store = watershed + '_upstream_soil_' + outletID
-                    var soil_store_id = gs_workspace + ':' + soil_store
-                    var style = watershed + '-' + data.raster_type
-
-                    //     Set the wms source to the url, workspace, and store for the subbasins of the selected watershed
-                    var soil_wms_source = new ol.source.ImageWMS({
-                        url: geoserver_url,
-                        params: {'LAYERS':soil_store_id, 'STYLES':style},
-                        serverType: 'geoserver',
+
+                    //     The clipped raster is rendered by the app as XYZ tiles instead of a GeoServer layer
+                    var soil_tile_source = new ol.source.XYZ({
+                        url: clip_tile_url(data.clip, 'soil', 'class'),
                         crossOrigin: 'Anonymous'
                     });
 
-                    upstream_soil = new ol.layer.Image({
-                        source: soil_wms_source
+                    upstream_soil = new ol.layer.Tile({
+                        source: soil_tile_source
                     });
                     $('#soil-loading').addClass('hidden')
                     soil_map.addLayer(upstream_soil);
@@ -1092,15 +1059,13 @@ var LIBRARY_OBJECT = (function() {
         });
     }
 
-    get_time_series = function(watershed_id, watershed, start, end, parameters, streamID, fileType) {
-//      Function to pass selected dates, parameters, and streamID to the rch data parser python function and then plot the data
-        var monthOrDay
-        monthOrDay = 'Daily'
-//        if ($(".toggle").hasClass( "off" )) {
-//            monthOrDay = 'Daily'
-//        } else {
-//            monthOrDay = 'Monthly'
-//        }
+    get_time_series = function(watershed_id, watershed, start, end, parameters, streamID, fileType, monthOrDay) {
+//      Function to pass selected dates, parameters, timestep and streamID to the rch data parser python function and then plot the data
+//      Daily series are downsampled on the server to about two points per pixel of chart width
+        var max_points = ''
+        if (monthOrDay == 'Daily') {
+            max_points = 2000
+        }
 //      AJAX call to the timeseries python controller to run the rch data parser function
         $.ajax({
             type: 'POST',
@@ -1113,7 +1078,8 @@ var LIBRARY_OBJECT = (function() {
                 'parameters': parameters,
                 'streamID': streamID,
                 'monthOrDay': monthOrDay,
-                'fileType': fileType
+                'fileType': fileType,
+                'max_points': max_points
             },
             error: function () {
                 $('#error').html('<p class="alert alert-danger" style="text-align: center"><strong>An unknown error occurred while retrieving the data. Please try again</strong></p>');
@@ -1258,10 +1224,14 @@ var LIBRARY_OBJECT = (function() {
     };
 
     add_to_cart = function(){
+//      Only the request is sent back; the server reads the values from the database itself
+        var request = JSON.parse(sessionStorage.timeseries)
+        delete request.Values
+        delete request.Dates
         $.ajax({
             type: 'POST',
             url: "/apps/swatdv/save_file/",
-            data: sessionStorage.timeseries,
+            data: JSON.stringify(request),
             success: function(result){
                 var fileType = result.FileType
                 var newrow = '<tr><td>' + result.FileType + '</td><td>' + result.Parameters + '</td><td>' +
@@ -1286,6 +1256,30 @@ var LIBRARY_OBJECT = (function() {
     };
 
 
+    coverage_pending = function(job_id, raster_type, compute) {
+        // watersheds uploaded without histograms are counted from the outlet's clip, which is made in the background;
+        // ask for the coverages again once it exists
+        $.ajax({
+            type: "GET",
+            url: '/apps/swatdv/clip_status/',
+            data: {
+                'job_id': job_id
+            },
+            success: function(data) {
+                if (data.status == 'failed') {
+                    $('#' + raster_type + '-pie-loading').addClass('hidden')
+                    alert('Clipping the ' + raster_type + ' raster failed: ' + data.error)
+                } else if (data.status == 'done') {
+                    compute()
+                } else {
+                    setTimeout(function() {
+                        coverage_pending(job_id, raster_type, compute)
+                    }, 1000)
+                }
+            }
+        })
+    }
+
     soil_compute = function(){
         var watershed = sessionStorage.watershed
         var watershed_id = sessionStorage.watershed_id
@@ -1304,7 +1298,11 @@ var LIBRARY_OBJECT = (function() {
                 'raster_type': rasterType
                 },
             success: function(result){
-                $('#soil-loading').addClass('hidden')
+                if (result.status == 'pending') {
+                    coverage_pending(result.job_id, 'soil', soil_compute)
+                    return
+                }
+                $('#soil-pie-loading').addClass('hidden')
                 var classValues = result.classValues
                 var classColors = result.classColors
                 var classData = []
@@ -1369,6 +1367,10 @@ var LIBRARY_OBJECT = (function() {
                 'raster_type': rasterType
                 },
             success: function(result){
+                if (result.status == 'pending') {
+                    coverage_pending(result.job_id, 'lulc', lulc_compute)
+                    return
+                }
                 $('#lulc-pie-loading').addClass('hidden')
 //            plot coverage percentages in pie chart
                 var classes = result.classes
@@ -1746,7 +1748,8 @@ var LIBRARY_OBJECT = (function() {
             });
             var streamID = sessionStorage.streamID
             var fileType = 'rch'
-            get_time_series(watershed_id, watershed, start, end, parameters, streamID, fileType);
+            var monthOrDay = $('#rch_timestep_select').val()
+            get_time_series(watershed_id, watershed, start, end, parameters, streamID, fileType, monthOrDay);
         })
 
         $("#sub_compute").click(function(){
@@ -1760,7 +1763,8 @@ var LIBRARY_OBJECT = (function() {
             });
             var streamID = sessionStorage.streamID
             var fileType = 'sub'
-            get_time_series(watershed_id, watershed, start, end, parameters, streamID, fileType);
+            var monthOrDay = $('#sub_timestep_select').val()
+            get_time_series(watershed_id, watershed, start, end, parameters, streamID, fileType, monthOrDay);
         })
 
         $('#clip_lulc').click(function(){
@@ -0,0 +1,35 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+# REST store type, upload path and content type of each publishable file type
+upload_types = {'.tif': ('coveragestores', 'file.geotiff', 'image/tiff'),
+                '.zip': ('datastores', 'file.shp', 'application/zip')}
+
+
+class GeoServerPublisher(object):
+    '''
+    Uploads rasters and zipped shapefiles to one GeoServer workspace over a pooled keep-alive session, streaming
+    each file body from disk
+    '''
+
+    def __init__(self, rest_url, workspace, user, password, pool_size=10):
+        self.rest_url = rest_url if rest_url.endswith('/') else rest_url + '/'
+        self.workspace = workspace
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def store_url(self, store_type, store):
+        return '{0}workspaces/{1}/{2}/{3}'.format(self.rest_url, self.workspace, store_type, store)
+
+    def publish(self, path, store):
+        # upload the file at path as store, replacing the store's file if it already exists
+        store_type, upload_path, content_type = upload_types[os.path.splitext(path)[1].lower()]
+        with open(path, 'rb') as data:
+            response = self.session.put(self.store_url(store_type, store) + '/' + upload_path, data=data,
+                                        headers={'Content-type': content_type})
+        response.raise_for_status()
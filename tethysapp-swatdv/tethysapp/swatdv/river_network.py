@@ -0,0 +1,122 @@
+import numpy as np
+
+
+def nested_intervals(stream_ids, to_nodes):
+    '''
+    Label each reach with its depth-first entry (lft) and the largest entry in its upstream subtree (rgt), so the
+    reaches upstream of X, X included, are exactly those with X.lft <= lft <= X.rgt.
+    Reaches whose to_node is not a reach of the network (0 for the SWAT outlet) are outlets.
+    '''
+    stream_ids = np.asarray(stream_ids, dtype=np.int64)
+    to_nodes = np.asarray(to_nodes, dtype=np.int64)
+    position = dict(zip(stream_ids.tolist(), range(len(stream_ids))))
+
+    children = [[] for _ in range(len(stream_ids))]
+    outlets = []
+    for i, to_node in enumerate(to_nodes.tolist()):
+        if to_node in position and position[to_node] != i:
+            children[position[to_node]].append(i)
+        else:
+            outlets.append(i)
+
+    lft = np.full(len(stream_ids), -1, dtype=np.int64)
+    rgt = np.full(len(stream_ids), -1, dtype=np.int64)
+    counter = 0
+    for outlet in outlets:
+        # iterative DFS so large basins cannot hit the recursion limit; a node is closed when popped a second time
+        stack = [(outlet, False)]
+        while stack:
+            node, closing = stack.pop()
+            if closing:
+                rgt[node] = counter - 1
+                continue
+            lft[node] = counter
+            counter += 1
+            stack.append((node, True))
+            for child in reversed(children[node]):
+                if lft[child] < 0:
+                    stack.append((child, False))
+    return lft, rgt
+
+
+class RiverNetwork(object):
+    '''
+    A watershed's reach network held in compact arrays: parent[i] is the index of the reach that reach i drains to
+    (-1 for outlets) and the upstream neighbours of reach i are children[child_ptr[i]:child_ptr[i + 1]] (CSR).
+    Reach i's upstream subtree is order[lft[i]:rgt[i] + 1], so depth-first order is also a topological order in
+    which every subtree is one contiguous segment.
+    '''
+
+    def __init__(self, stream_ids, to_nodes, areas=None):
+        self.ids = np.asarray(stream_ids, dtype=np.int64)
+        # subbasin area of each reach in km2 (NaN where unknown)
+        self.areas = np.full(len(self.ids), np.nan) if areas is None else np.asarray(areas, dtype=np.float64)
+        to_nodes = np.asarray(to_nodes, dtype=np.int64)
+        self.position = dict(zip(self.ids.tolist(), range(len(self.ids))))
+
+        parent = np.array([self.position.get(to_node, -1) for to_node in to_nodes.tolist()], dtype=np.int64)
+        parent[parent == np.arange(len(parent))] = -1
+        self.parent = parent
+
+        has_parent = parent >= 0
+        self.children = np.flatnonzero(has_parent)[np.argsort(parent[has_parent], kind='stable')]
+        self.child_ptr = np.zeros(len(parent) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parent[has_parent], minlength=len(parent)), out=self.child_ptr[1:])
+
+        self.lft, self.rgt = nested_intervals(self.ids, to_nodes)
+        self.order = np.argsort(self.lft)
+
+    def index(self, stream_id):
+        return self.position[int(stream_id)]
+
+    def upstream(self, stream_id):
+        # the reach and everything draining to it, outlet first in depth-first order
+        i = self.index(stream_id)
+        return self.ids[self.order[self.lft[i]:self.rgt[i] + 1]].tolist()
+
+    def downstream(self, stream_id):
+        # the reach and every reach on the way to its outlet
+        path = [self.index(stream_id)]
+        while self.parent[path[-1]] >= 0:
+            path.append(self.parent[path[-1]])
+        return self.ids[path].tolist()
+
+    def path(self, from_id, to_id):
+        # reaches on the flow path between two reaches, from from_id to to_id; None if they are not connected
+        down_from = self.downstream(from_id)
+        down_to = self.downstream(to_id)
+        if down_from[-1] != down_to[-1]:
+            return None
+        # drop the shared part below the first common reach, then walk down one branch and up the other
+        shared = 0
+        while shared < min(len(down_from), len(down_to)) and down_from[-1 - shared] == down_to[-1 - shared]:
+            shared += 1
+        return down_from[:len(down_from) - shared + 1] + down_to[:len(down_to) - shared][::-1]
+
+    def main_stem(self, stream_id):
+        # from the reach up to a headwater, always following the tributary with the most upstream reaches
+        i = self.index(stream_id)
+        stem = [i]
+        while self.child_ptr[i + 1] > self.child_ptr[i]:
+            upstream = self.children[self.child_ptr[i]:self.child_ptr[i + 1]]
+            i = upstream[np.argmax(self.rgt[upstream] - self.lft[upstream])]
+            stem.append(i)
+        return self.ids[stem].tolist()
+
+    def segment_sums(self, stream_ids, values, outlet_ids):
+        '''
+        Sum values (aligned with stream_ids along the first axis) over the upstream subtree of each outlet.
+        The rows are put in depth-first order once, after which every outlet's total is the difference of two
+        prefix sums, however many reaches drain to it. Reaches missing from stream_ids count as zero.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        positions = self.lft[[self.index(stream_id) for stream_id in stream_ids]]
+        order = np.argsort(positions)
+        positions = positions[order]
+        prefix = np.zeros((len(order) + 1,) + values.shape[1:])
+        np.cumsum(values[order], axis=0, out=prefix[1:])
+
+        outlets = np.array([self.index(outlet_id) for outlet_id in outlet_ids], dtype=np.int64)
+        first = np.searchsorted(positions, self.lft[outlets], side='left')
+        last = np.searchsorted(positions, self.rgt[outlets], side='right')
+        return prefix[last] - prefix[first]
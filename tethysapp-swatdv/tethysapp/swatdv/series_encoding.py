@@ -0,0 +1,69 @@
+import json, struct
+import numpy as np
+
+
+def epoch_ms(days):
+    return days.astype('datetime64[ms]').astype(np.int64)
+
+
+def series_pairs(times, series):
+    # [[ms, val], ...] for Highcharts, with missing values sent as null
+    vals = series.astype(object)
+    vals[np.isnan(series)] = None
+    return np.column_stack((times.astype(object), vals)).tolist()
+
+
+def lttb(times, series, max_points):
+    # Largest-Triangle-Three-Buckets: indices of at most max_points values that keep the visual shape of the series
+    valid = np.flatnonzero(~np.isnan(series))
+    n = len(valid)
+    if n <= max_points or max_points < 3:
+        return valid
+    x = times[valid].astype(np.float64)
+    y = series[valid]
+
+    # first and last points are always kept; the rest is split into max_points - 2 buckets of near equal size
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:edges[-1]], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:edges[-1]], edges[:-1]) / counts
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    # the buckets holding the overall maximum and minimum keep those points so peaks are never flattened
+    forced = {}
+    for peak in (np.argmax(y), np.argmin(y)):
+        bucket = np.searchsorted(edges, peak, side='right') - 1
+        if 0 <= bucket < len(counts):
+            forced.setdefault(bucket, peak)
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for b in range(len(counts)):
+        if b in forced:
+            a = forced[b]
+        else:
+            lo, hi = edges[b], edges[b + 1]
+            area = np.abs((x[a] - next_x[b]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[b] - y[a]))
+            a = lo + np.argmax(area)
+        selected[b + 1] = a
+    return valid[selected]
+
+
+def pack_timeseries(header, axis, values):
+    # binary timeseries: b'SWTS', uint32 header length, JSON header, [int64 times], one float32 block per parameter.
+    # Daily series share a regular axis described by Start and Step (ms), so only monthly and annual series
+    # carry an explicit times block. All numbers are little-endian and missing values are NaN.
+    times = epoch_ms(axis.astype('datetime64[D]'))
+    header = dict(header, Start=int(times[0]), Count=len(times),
+                  Step=86400000 if axis.dtype == np.dtype('datetime64[D]') else None)
+    header_bytes = json.dumps(header).encode('utf-8')
+    # pad the header with spaces so the typed blocks start on an 8 byte boundary
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+    blocks = [b'SWTS', struct.pack('<I', len(header_bytes)), header_bytes]
+    if header['Step'] is None:
+        blocks.append(times.astype('<i8').tobytes())
+    blocks.append(np.ascontiguousarray(values, dtype='<f4').tobytes())
+    return b''.join(blocks)
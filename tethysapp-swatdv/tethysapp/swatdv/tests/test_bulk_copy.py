@@ -0,0 +1,53 @@
+import unittest
+
+from ..bulk_copy import CopyStream, copy_value
+
+"""
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.swatdv.tests.test_bulk_copy"
+"""
+
+
+class CopyStreamTestCase(unittest.TestCase):
+    """
+    CopyStream is what copy_expert reads COPY text from, so it has to hand back exactly the pieces it was given
+    without holding more than one read's worth of them.
+    """
+
+    def test_pieces_larger_than_read_size(self):
+        size = 1000
+        pieces = [str(i % 10) * (3 * size + i) for i in range(50)]
+        consumed = []
+
+        def generate():
+            for piece in pieces:
+                consumed.append(piece)
+                yield piece
+
+        stream = CopyStream(generate())
+        data = []
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), size)
+            # what is held after a read is never more than one piece
+            self.assertLess(stream.buffered, max(len(piece) for piece in pieces))
+            # and pieces are only pulled once the buffer runs low
+            self.assertLessEqual(sum(len(piece) for piece in consumed), sum(len(d) for d in data) + len(chunk) +
+                                 stream.buffered)
+            data.append(chunk)
+        self.assertEqual(''.join(data), ''.join(pieces))
+
+    def test_small_pieces_and_read_all(self):
+        lines = ['{0}\t{1}\n'.format(i, i * 2) for i in range(1000)]
+        stream = CopyStream(lines)
+        first = stream.read(7)
+        self.assertEqual(first, '0\t0\n1\t2')
+        self.assertEqual(first + stream.read(), ''.join(lines))
+        self.assertEqual(stream.read(10), '')
+
+    def test_copy_value(self):
+        self.assertEqual(copy_value(None), '\\N')
+        self.assertEqual(copy_value([1.5, 2, None]), '{1.5,2.0,NULL}')
+        self.assertEqual(copy_value('a\tb\\c\n'), 'a\\tb\\\\c\\n')
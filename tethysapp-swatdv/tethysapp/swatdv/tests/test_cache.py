@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ..cache import DiskCache, FileCache, MemoryCache
+
+"""
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.swatdv.tests.test_cache"
+"""
+
+
+class MemoryCacheTestCase(unittest.TestCase):
+    """
+    MemoryCache evicts the least recently used values once their total size passes max_bytes
+    """
+
+    def test_lru_eviction(self):
+        cache = MemoryCache(100)
+        cache.put('a', 'A', 40)
+        cache.put('b', 'B', 40)
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('c', 'C', 40)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['hits'], stats['misses']), (2, 80, 3, 1))
+
+    def test_replace_and_oversized_values(self):
+        cache = MemoryCache(100)
+        cache.put('a', 'A', 40)
+        cache.put('a', 'AA', 60)
+        self.assertEqual(cache.get('a'), 'AA')
+        self.assertEqual(cache.stats()['bytes'], 60)
+        cache.put('big', 'X', 101)
+        self.assertIsNone(cache.get('big'))
+        self.assertEqual(cache.get('a'), 'AA')
+
+
+class DiskCacheTestCase(unittest.TestCase):
+    """
+    DiskCache keeps values in pickle files and removes the least recently used files past max_bytes
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        cache = DiskCache(self.path, 1024 * 1024)
+        self.assertIsNone(cache.get(('rch', 1)))
+        cache.put(('rch', 1), {'values': [1.0, 2.0]}, 100)
+        self.assertEqual(DiskCache(self.path, 1024 * 1024).get(('rch', 1)), {'values': [1.0, 2.0]})
+
+    def test_eviction_by_last_use(self):
+        value = 'x' * 1000
+        cache = DiskCache(self.path, 1024 * 1024)
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, value, len(value))
+            os.utime(cache.file_path(key), (time.time() - 100 + i, time.time() - 100 + i))
+        size = os.path.getsize(cache.file_path('a'))
+        # using a makes b the least recently used file
+        cache.get('a')
+        cache.max_bytes = 3 * size - 1
+        cache.evict()
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), value)
+        self.assertEqual(cache.get('c'), value)
+
+
+class FileCacheTestCase(unittest.TestCase):
+    """
+    FileCache creates each file once however many requests ask for it, and its locks do not outlive the requests
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_single_creation_under_concurrency(self):
+        cache = FileCache(self.path, 1024 * 1024, '.tif')
+        created = []
+
+        def create(path):
+            created.append(path)
+            time.sleep(0.1)
+            with open(path, 'w') as f:
+                f.write('clip')
+
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(cache.get_or_create(('ws', '7', 'lulc'), create)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len(set(paths)), 1)
+        self.assertTrue(paths[0].endswith('.tif'))
+        with open(paths[0]) as f:
+            self.assertEqual(f.read(), 'clip')
+        self.assertEqual(cache.locks, {})
+        self.assertEqual(cache.get(('ws', '7', 'lulc')), paths[0])
+        self.assertIsNone(cache.get(('ws', '8', 'lulc')))
+
+    def test_failed_creation_leaves_nothing(self):
+        cache = FileCache(self.path, 1024 * 1024, '.tif')
+
+        def create(path):
+            raise IOError('warp failed')
+
+        self.assertRaises(IOError, cache.get_or_create, 'key', create)
+        self.assertFalse([name for name in os.listdir(self.path) if name.endswith(('.tif', '.tmp'))])
+        self.assertEqual(cache.locks, {})
+
+    def test_eviction_removes_lock_files(self):
+        cache = FileCache(self.path, 2500, '.tif')
+
+        def create(path):
+            with open(path, 'w') as f:
+                f.write('x' * 1000)
+
+        first = cache.get_or_create('a', create)
+        os.utime(first, (time.time() - 100, time.time() - 100))
+        cache.get_or_create('b', create)
+        cache.get_or_create('c', create)
+
+        self.assertFalse(os.path.exists(first))
+        self.assertFalse(os.path.exists(first + '.lock'))
+        self.assertEqual(sorted(name for name in os.listdir(self.path) if name.endswith('.tif')),
+                         sorted(os.path.basename(cache.file_path(key)) for key in ('b', 'c')))
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.lock')]), 2)
@@ -0,0 +1,38 @@
+import unittest
+
+from ..database import plain_statement, prepared_statements
+
+"""
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.swatdv.tests.test_database"
+"""
+
+
+class PlainStatementTestCase(unittest.TestCase):
+    """
+    plain_statement is the fallback for statements a connection could not prepare, so its bound parameters must
+    line up with the arguments fetch passes as p0, p1, ...
+    """
+
+    def test_placeholders(self):
+        statement = plain_statement('coverage_histogram')
+        self.assertNotIn('$', statement)
+        self.assertIn('watershed_id=:p0', statement)
+        self.assertIn('raster_type=:p1', statement)
+        self.assertIn('ANY(:p2)', statement)
+
+    def test_file_type_variants(self):
+        statement = plain_statement('series_rows_rch')
+        self.assertIn('FROM output_rch ', statement)
+        self.assertIn('reach_id = ANY(:p1)', statement)
+        self.assertIn('BETWEEN :p3 AND :p4', statement)
+        self.assertIn('sub_id', plain_statement('series_rows_sub'))
+
+    def test_every_statement(self):
+        for name, (arg_types, query) in prepared_statements.items():
+            names = [name + '_rch', name + '_sub'] if '{0}' in query else [name]
+            for statement_name in names:
+                statement = plain_statement(statement_name)
+                self.assertNotIn('$', statement)
+                for i in range(len(arg_types.split(','))):
+                    self.assertIn(':p{0}'.format(i), statement)
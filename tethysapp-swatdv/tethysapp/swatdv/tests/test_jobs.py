@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ..jobs import JobQueue
+
+"""
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.swatdv.tests.test_jobs"
+"""
+
+
+class JobQueueTestCase(unittest.TestCase):
+    """
+    JobQueue runs jobs in the background, shares a running job between identical requests and drops old status
+    files
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.queue = JobQueue(self.path, 2, 3600)
+
+    def tearDown(self):
+        self.queue.executor.shutdown(wait=True)
+        shutil.rmtree(self.path)
+
+    def wait(self, job_id, timeout=5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = self.queue.status(job_id)
+            # the job leaves running just after its final status is written
+            if status and status['status'] in ('done', 'failed') and job_id not in self.queue.running.values():
+                return status
+            time.sleep(0.01)
+        self.fail('job {0} did not finish'.format(job_id))
+
+    def test_result_and_progress(self):
+        def job(progress, a, b):
+            progress(0.5, 'adding')
+            return {'total': a + b}
+
+        job_id = self.queue.submit(('add', 1), job, 2, 3, watershed='ws')
+        status = self.wait(job_id)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['total'], 5)
+        self.assertEqual(status['watershed'], 'ws')
+        self.assertEqual(status['progress'], 1.0)
+        self.assertEqual(self.queue.running, {})
+
+    def test_identical_jobs_are_shared(self):
+        release = threading.Event()
+        calls = []
+
+        def job(progress):
+            calls.append(1)
+            release.wait(5)
+            return {}
+
+        first = self.queue.submit('clip', job)
+        second = self.queue.submit('clip', job)
+        other = self.queue.submit('other clip', job)
+        release.set()
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.wait(first)
+        self.wait(other)
+        self.assertEqual(len(calls), 2)
+
+        # once finished, the same key runs again
+        third = self.queue.submit('clip', job)
+        self.assertNotEqual(third, first)
+        self.wait(third)
+
+    def test_failure_is_reported(self):
+        def job(progress):
+            raise ValueError('no cutline')
+
+        status = self.wait(self.queue.submit('bad', job))
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['error'], 'no cutline')
+
+    def test_unknown_and_malformed_ids(self):
+        self.assertIsNone(self.queue.status('0' * 32))
+        self.assertIsNone(self.queue.status('../../etc/passwd'))
+        self.assertIsNone(self.queue.status(None))
+
+    def test_expire(self):
+        job_id = self.queue.submit('old', lambda progress: {})
+        self.wait(job_id)
+        old = time.time() - 7200
+        os.utime(self.queue.status_path(job_id), (old, old))
+        self.queue.expire()
+        self.assertIsNone(self.queue.status(job_id))
+        self.assertEqual(os.listdir(self.path), [])
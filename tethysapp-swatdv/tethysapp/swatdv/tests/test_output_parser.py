@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..outputs_config import sub_column_list
+from ..output_parser import output_extent, parse_output_file
+
+"""
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.swatdv.tests.test_output_parser"
+"""
+
+sub_ids = [1, 2, 999, 1000, 1234]
+days = np.arange(np.datetime64('2000-01-30'), np.datetime64('2000-02-04'))
+
+
+def output_line(sub_id, day, variables):
+    # a line as SWAT writes it: the label is glued to ids that need its room (BIGSUB1000)
+    date = day.astype(object)
+    label = 'BIGSUB{0:4d}'.format(sub_id) if sub_id >= 1000 else 'SUB {0:4d}'.format(sub_id)
+    values = ''.join('{0:11.3E}'.format(sub_id + variable + (day - days[0]).astype(int) / 1000.0)
+                     for variable in range(variables))
+    return '{0}{1:9d}{2:4d}{3:3d}{4:5d}{5:11.4E}{6}\n'.format(label, 0, date.month, date.day, date.year,
+                                                              sub_id * 1.5, values)
+
+
+class ParseOutputFileTestCase(unittest.TestCase):
+    """
+    parse_output_file reads the file in blocks of whole lines, so the results must not depend on where the
+    blocks end
+    """
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.path = os.path.join(self.workspace, 'output.sub')
+        variables = len(sub_column_list) - 7
+        with open(self.path, 'w') as f:
+            f.write('SWAT output header\n\n')
+            f.write('      SUB      GIS  MO DA   YR   AREAkm2 ' + ' '.join(sub_column_list[7:]) + '\n')
+            for day in days:
+                for sub_id in sub_ids:
+                    f.write(output_line(sub_id, day, variables))
+        self.file_vars = ['PRECIPmm', 'SWmm', 'TNO3kg/ha']
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def parse(self, chunk_bytes):
+        chunks = list(parse_output_file(self.path, sub_column_list, self.file_vars, chunk_bytes=chunk_bytes))
+        return chunks, [np.concatenate([chunk[i] for chunk in chunks], axis=-1) for i in range(3)]
+
+    def test_values(self):
+        chunks, (ids, dates, values) = self.parse(64 * 1024 * 1024)
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(ids.tolist(), sub_ids * len(days))
+        self.assertEqual(dates.tolist(), np.repeat(days, len(sub_ids)).tolist())
+        offsets = [sub_column_list.index(var) - 7 for var in self.file_vars]
+        expected = np.array([ids + offset + (dates - days[0]).astype(int) / 1000.0 for offset in offsets])
+        np.testing.assert_allclose(values, expected, rtol=1e-3)
+
+    def test_chunk_boundaries(self):
+        whole = self.parse(64 * 1024 * 1024)[1]
+        for chunk_bytes in (1, 97, 250, 1000):
+            chunks, parsed = self.parse(chunk_bytes)
+            self.assertGreater(len(chunks), 1)
+            for expected, actual in zip(whole, parsed):
+                np.testing.assert_array_equal(expected, actual)
+
+    def test_output_extent(self):
+        ids, start, end = output_extent(self.path, sub_column_list)
+        self.assertEqual(ids.tolist(), sub_ids)
+        self.assertEqual(start, days[0])
+        self.assertEqual(end, days[-1])
+
+    def test_file_without_data(self):
+        with open(self.path, 'w') as f:
+            f.write('SWAT output header\n\n      SUB      GIS  MO DA   YR   AREAkm2\n')
+        ids, start, end = output_extent(self.path, sub_column_list)
+        self.assertEqual(len(ids), 0)
+        self.assertIsNone(start)
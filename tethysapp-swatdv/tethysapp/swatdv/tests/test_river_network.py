@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+from ..river_network import RiverNetwork, nested_intervals
+
+"""
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.swatdv.tests.test_river_network"
+"""
+
+# 1 is the outlet (to_node 0); 2 and 3 drain to 1, 4 and 5 to 2, 6 to 5, and 7 is a separate basin
+stream_ids = [1, 2, 3, 4, 5, 6, 7]
+to_nodes = [0, 1, 1, 2, 2, 5, 0]
+
+
+class NestedIntervalsTestCase(unittest.TestCase):
+    """
+    The reaches upstream of X, X included, are exactly those whose lft lies within X's [lft, rgt]
+    """
+
+    def test_intervals_match_upstream_sets(self):
+        lft, rgt = nested_intervals(stream_ids, to_nodes)
+        self.assertEqual(sorted(lft.tolist()), list(range(len(stream_ids))))
+        upstream_sets = {1: {1, 2, 3, 4, 5, 6}, 2: {2, 4, 5, 6}, 3: {3}, 4: {4}, 5: {5, 6}, 6: {6}, 7: {7}}
+        for i, stream_id in enumerate(stream_ids):
+            inside = set(np.array(stream_ids)[(lft >= lft[i]) & (lft <= rgt[i])].tolist())
+            self.assertEqual(inside, upstream_sets[stream_id])
+
+    def test_long_chain_does_not_recurse(self):
+        n = 50000
+        lft, rgt = nested_intervals(list(range(1, n + 1)), list(range(0, n)))
+        self.assertEqual(lft[0], 0)
+        self.assertEqual(rgt[0], n - 1)
+        self.assertEqual(lft[-1], n - 1)
+
+
+class RiverNetworkTestCase(unittest.TestCase):
+    """
+    Upstream, downstream and path queries on a small network with two branches and a second outlet
+    """
+
+    def setUp(self):
+        self.network = RiverNetwork(stream_ids, to_nodes, areas=[1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])
+
+    def test_upstream(self):
+        self.assertEqual(self.network.upstream(1)[0], 1)
+        self.assertEqual(sorted(self.network.upstream(1)), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(sorted(self.network.upstream('2')), [2, 4, 5, 6])
+        self.assertEqual(self.network.upstream(6), [6])
+        self.assertEqual(self.network.upstream(7), [7])
+
+    def test_downstream(self):
+        self.assertEqual(self.network.downstream(6), [6, 5, 2, 1])
+        self.assertEqual(self.network.downstream(1), [1])
+
+    def test_path(self):
+        self.assertEqual(self.network.path(6, 1), [6, 5, 2, 1])
+        self.assertEqual(self.network.path(1, 6), [1, 2, 5, 6])
+        self.assertEqual(self.network.path(6, 3), [6, 5, 2, 1, 3])
+        self.assertEqual(self.network.path(4, 4), [4])
+        self.assertIsNone(self.network.path(6, 7))
+
+    def test_main_stem(self):
+        self.assertEqual(self.network.main_stem(1), [1, 2, 5, 6])
+
+    def test_segment_sums(self):
+        sums = self.network.segment_sums(stream_ids, self.network.areas, [1, 2, 5, 7])
+        self.assertEqual(sums.tolist(), [21.0, 17.0, 11.0, 7.0])
+        # reaches without values count as zero
+        self.assertEqual(self.network.segment_sums([6, 3], [[1.0, 2.0], [10.0, 20.0]], [2, 1]).tolist(),
+                         [[1.0, 2.0], [11.0, 22.0]])
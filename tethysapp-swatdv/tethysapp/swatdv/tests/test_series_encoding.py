@@ -0,0 +1,91 @@
+import json
+import struct
+import unittest
+
+import numpy as np
+
+from ..series_encoding import epoch_ms, lttb, pack_timeseries
+
+"""
+To run these tests:
+    Test command: "tethys test -f tethys_apps.tethysapp.swatdv.tests.test_series_encoding"
+"""
+
+
+def unpack_timeseries(data):
+    # the reader side of pack_timeseries, as main.js decodes it
+    assert data[:4] == b'SWTS'
+    header_length = struct.unpack('<I', data[4:8])[0]
+    header = json.loads(data[8:8 + header_length].decode('utf-8'))
+    offset = 8 + header_length
+    if header['Step'] is None:
+        times = np.frombuffer(data, dtype='<i8', count=header['Count'], offset=offset)
+        offset += 8 * header['Count']
+    else:
+        times = header['Start'] + header['Step'] * np.arange(header['Count'], dtype=np.int64)
+    values = np.frombuffer(data, dtype='<f4', offset=offset).reshape(-1, header['Count'])
+    return header, offset, times, values
+
+
+class LttbTestCase(unittest.TestCase):
+    """
+    lttb picks which points of a long series are plotted, so it has to keep the ends and the extremes
+    """
+
+    def setUp(self):
+        self.days = np.arange(np.datetime64('2000-01-01'), np.datetime64('2003-01-01'))
+        self.times = epoch_ms(self.days)
+        self.series = np.sin(np.arange(len(self.days)) / 30.0)
+
+    def test_short_series_is_kept_whole(self):
+        self.assertEqual(lttb(self.times[:100], self.series[:100], 500).tolist(), list(range(100)))
+
+    def test_downsampled_indices(self):
+        self.series[400] = 5.0
+        self.series[700] = -5.0
+        selected = lttb(self.times, self.series, 200)
+        self.assertEqual(len(selected), 200)
+        self.assertTrue(np.all(np.diff(selected) > 0))
+        self.assertEqual(selected[0], 0)
+        self.assertEqual(selected[-1], len(self.series) - 1)
+        self.assertIn(400, selected)
+        self.assertIn(700, selected)
+
+    def test_missing_values_are_skipped(self):
+        self.series[::3] = np.nan
+        selected = lttb(self.times, self.series, 100)
+        self.assertEqual(len(selected), 100)
+        self.assertFalse(np.isnan(self.series[selected]).any())
+
+        self.assertEqual(len(lttb(self.times, np.full(len(self.times), np.nan), 100)), 0)
+
+
+class PackTimeseriesTestCase(unittest.TestCase):
+    """
+    pack_timeseries writes the SWTS layout the page decodes: magic, header length, padded JSON header,
+    times only for irregular axes, then one float32 block per parameter
+    """
+
+    def test_daily_series_has_no_times_block(self):
+        axis = np.arange(np.datetime64('2001-03-01'), np.datetime64('2001-03-11'))
+        values = np.arange(20, dtype=np.float64).reshape(2, 10)
+        values[1, 3] = np.nan
+        header, offset, times, unpacked = unpack_timeseries(pack_timeseries({'Parameters': ['a', 'b']}, axis, values))
+
+        self.assertEqual(offset % 8, 0)
+        self.assertEqual(header['Parameters'], ['a', 'b'])
+        self.assertEqual(header['Count'], 10)
+        self.assertEqual(header['Step'], 86400000)
+        self.assertEqual(times.tolist(), epoch_ms(axis).tolist())
+        np.testing.assert_array_equal(unpacked, values.astype(np.float32))
+
+    def test_monthly_series_carries_its_times(self):
+        axis = np.arange(np.datetime64('2001-01'), np.datetime64('2002-01'))
+        values = np.linspace(0, 1, 12).reshape(1, 12)
+        data = pack_timeseries({'Timestep': 'Monthly'}, axis, values)
+        header, offset, times, unpacked = unpack_timeseries(data)
+
+        self.assertIsNone(header['Step'])
+        self.assertEqual(times.tolist(), epoch_ms(axis.astype('datetime64[D]')).tolist())
+        np.testing.assert_array_equal(unpacked, values.astype(np.float32))
+        self.assertEqual(len(data), offset + 4 * values.size)
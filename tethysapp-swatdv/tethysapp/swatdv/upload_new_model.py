@@ -1,5 +1,12 @@
-import os, re, psycopg2, zipfile, datetime, requests
+import os, json, psycopg2, zipfile, datetime, tempfile
+import numpy as np
+import pandas as pd
+from osgeo import gdal, ogr
 from dbfread import DBF
+from outputs_config import sub_column_list, rch_column_list
+from output_parser import parse_output_file, output_extent
+from publishing import GeoServerPublisher
+from bulk_copy import copy_lines, copy_rows
 
 
 # User specified options
@@ -7,6 +14,7 @@ watershed_name = '' #name of watershed to be used throughout the app (needs to b
 data_path = '' #path to folder containing all data for new model
 sub_vars = [''] #vars from output.sub file to upload to db (select from "sub_column_list")
 rch_vars = [''] #vars from output.rch file to upload to db (select from "rch_column_list")
+output_storage = 'rows' #'rows', 'array' or 'cube', must match output_storage in config.py
 
 #database specs
 db = {'name': 'swatdv_swat_db',
@@ -22,19 +30,18 @@ geoserver = {'url':'', # 'http://url or ip of GeoServer
              'password':'geoserver',
              'workspace':'swat'}
 
-# list of variables in SWAT output files used to index columns
-sub_column_list = ['', 'SUB', 'GIS', 'MO', 'DA', 'YR', 'AREAkm2', 'PRECIPmm', 'SNOMELTmm', 'PETmm', 'ETmm',
-                   'SWmm', 'PERCmm', 'SURQmm', 'GW_Qmm', 'WYLDmm', 'SYLDt/ha', 'ORGNkg/ha', 'ORGPkg/ha',
-                   'NSURQkg/ha', 'SOLPkg/ha', 'SEDPkg/ha', 'LATQmm', 'LATNO3kg/ha', 'GWNO3kg/ha', 'CHOLAmic/L',
-                   'CBODUmg/L', 'DOXQmg/L', 'TNO3kg/ha']
-rch_column_list = ['', 'RCH', 'GIS', 'MO', 'DA', 'YR', 'AREAkm2', 'FLOW_INcms', 'FLOW_OUTcms', 'EVAPcms', 'TLOSScms',
-                   'SED_INtons', 'SED_OUTtons', 'SEDCONCmg/kg', 'ORGN_INkg', 'ORGN_OUTkg', 'ORGP_INkg', 'ORGP_OUTkg',
-                   'NO3_INkg','NO3_OUTkg', 'NH4_INkg', 'NH4_OUTkg', 'NO2_INkg', 'NO2_OUTkg', 'MINP_INkg', 'MINP_OUTkg',
-                   'SOLPST_OUTmg', 'SORPST_INmg', 'SORPST_OUTmg', 'REACTPSTmg', 'VOLPSTmg', 'SETTLPSTmg', 'RESUSP_PSTmg',
-                   'DIFFUSEPSTmg', 'REACBEDPSTmg', 'BURYPSTmg', 'BED_PSTmg', 'BACTP_OUTct', 'BACTLP_OUTct', 'CMETAL#1kg',
-                   'CMETAL#2kg', 'CMETAL#3kg', 'TOTNkg', 'TOTPkg', 'NO3ConcMg/l', 'WTMPdegc']
+#one pooled, streaming GeoServer client for every upload
+publisher = GeoServerPublisher('{0}:{1}/geoserver/rest/'.format(geoserver['url'], geoserver['port']),
+                               geoserver['workspace'], geoserver['user'], geoserver['password'])
 
 #data upload functions
+def connect(db):
+    # one connection is shared by every upload stage
+    return psycopg2.connect(
+        'dbname={0} user={1} password={2} host={3} port={4}'
+            .format(db['name'], db['user'], db['pass'], db['host'], db['port'])
+    )
+
 def check_available_files(watershed_name, data_path):
     print('Gathering all available data files for upload')
     files = {}
@@ -66,12 +73,8 @@ def check_available_files(watershed_name, data_path):
         return 1
     return files
 
-def new_watershed(db, watershed_name):
+def new_watershed(conn, watershed_name):
     print('Creating new watershed in database')
-    conn = psycopg2.connect(
-        'dbname={0} user={1} password={2} host={3} port={4}'
-            .format(db['name'], db['user'], db['pass'], db['host'], db['port'])
-    )
     cur = conn.cursor()
     cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
     records = cur.fetchall()
@@ -85,65 +88,196 @@ def new_watershed(db, watershed_name):
         conn.commit()
         return 0
 
-def upload_swat_outputs(db, output_path, watershed_name, sub_vars, rch_vars):
+def create_partitions(conn, watershed_name):
+    print('Creating output table partitions for the new watershed')
+    cur = conn.cursor()
+    cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
+    records = cur.fetchall()
+    watershed_id = records[0][0]
+
+    for table in ['output_rch', 'output_sub']:
+        cur.execute("""SELECT relkind FROM pg_class WHERE relname = '{0}'""".format(table))
+        relkind = cur.fetchall()
+        if len(relkind) > 0 and relkind[0][0] == 'p':
+            cur.execute("""CREATE TABLE IF NOT EXISTS {0}_{1} PARTITION OF {0} FOR VALUES IN ({1})"""
+                        .format(table, watershed_id))
+    conn.commit()
+
+def output_lines(file_path, watershed_id, column_list, file_vars, piece_rows=65536):
+    # COPY text with one row per (line x variable), formatted by pandas piece_rows rows of one variable at a time so
+    # every piece CopyStream holds stays a few MB however large the parsed chunks are
+    for ids, dates, values in parse_output_file(file_path, column_list, file_vars):
+        # dates are formatted once per chunk by numpy, which is much faster than to_csv's datetime formatting
+        dates = np.datetime_as_string(dates, unit='D')
+        for var_name, vals in zip(file_vars, values):
+            for start in range(0, len(ids), piece_rows):
+                piece = slice(start, start + piece_rows)
+                yield pd.DataFrame({'watershed_id': watershed_id, 'year_month_day': dates[piece], 'id': ids[piece],
+                                    'var_name': var_name, 'val': vals[piece]}).to_csv(sep='\t', header=False,
+                                                                                     index=False, na_rep='\\N')
+
+def upload_swat_outputs(conn, output_path, watershed_name, sub_vars, rch_vars):
     print('SWAT output files')
-    conn = psycopg2.connect(
-        'dbname={0} user={1} password={2} host={3} port={4}'
-            .format(db['name'], db['user'], db['pass'], db['host'], db['port'])
-    )
     cur = conn.cursor()
     cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
     records = cur.fetchall()
     watershed_id = records[0][0]
 
     for file in os.listdir(output_path):
-        #upload output.sub data to PostgreSQL database
         if file.endswith('.sub'):
-            print('uploading output.sub to database')
-            sub_path = os.path.join(output_path, file)
-            f = open(sub_path)
-            for skip_line in f:
-                if 'AREAkm2' in skip_line:
-                    break
-            for num, line in enumerate(f, 1):
-                line = str(line.strip())
-                columns = line.split()
-                if re.match('^(?=.*[0-9]$)(?=.*[a-zA-Z])', columns[0]): #split the first column
-                    split = columns[0]
-                    columns[0] = split[:6]
-                    columns.insert(1, split[6:])
-                for idx, item in enumerate(sub_vars):
-                    sub = int(columns[1])
-                    dt = datetime.date(int(columns[5]), int(columns[3]), int(columns[4]))
-                    var_name = item
-                    val = float(columns[sub_column_list.index(item)])
-                    cur.execute("""INSERT INTO output_sub (watershed_id, year_month_day, sub_id, var_name, val)
-                         VALUES ({0}, '{1}', {2}, '{3}', {4})""".format(watershed_id, dt, sub, var_name, val))
-
-                conn.commit()
-
-        #upload output.rch data to PostgreSQL database
-        if file.endswith('.rch'):
-            print('uploading output_daily.rch to database')
-            print('rch')
-            rch_path = os.path.join(output_path, file)
-            f = open(rch_path)
-            for skip_line in f:
-                if 'AREAkm2' in skip_line:
-                    break
-            for num, line in enumerate(f, 1):
-                line = str(line.strip())
-                columns = line.split()
-                for idx, item in enumerate(rch_vars):
-                    reach = int(columns[1])
-                    dt = datetime.date(int(columns[5]), int(columns[3]), int(columns[4]))
-                    var_name = item
-                    val = float(columns[rch_column_list.index(item)])
-                    cur.execute("""INSERT INTO output_rch (watershed_id, year_month_day, reach_id, var_name, val)
-                                VALUES ({0}, '{1}', {2}, '{3}', {4})""".format(watershed_id, dt, reach, var_name, val))
-
-                conn.commit()
-    conn.close()
+            table, id_column, column_list, file_vars = 'output_sub', 'sub_id', sub_column_list, sub_vars
+        elif file.endswith('.rch'):
+            table, id_column, column_list, file_vars = 'output_rch', 'reach_id', rch_column_list, rch_vars
+        else:
+            continue
+        print('uploading ' + file + ' to database')
+
+        # each file is loaded in a single transaction
+        copy_lines(cur, table, ('watershed_id', 'year_month_day', id_column, 'var_name', 'val'),
+                   output_lines(os.path.join(output_path, file), watershed_id, column_list, file_vars))
+        conn.commit()
+
+def upload_swat_output_series(conn, output_path, watershed_name, sub_vars, rch_vars):
+    print('SWAT output files (array storage)')
+    cur = conn.cursor()
+    cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
+    records = cur.fetchall()
+    watershed_id = records[0][0]
+
+    for file in os.listdir(output_path):
+        if file.endswith('.sub'):
+            table, id_column, column_list, file_vars = 'output_sub_series', 'sub_id', sub_column_list, sub_vars
+        elif file.endswith('.rch'):
+            table, id_column, column_list, file_vars = 'output_rch_series', 'reach_id', rch_column_list, rch_vars
+        else:
+            continue
+        print('uploading ' + file + ' to database')
+
+        file_path = os.path.join(output_path, file)
+        # first pass finds the reach/subbasin ids and the date range, as for the output cubes
+        ids, start, end = output_extent(file_path, column_list)
+        if len(ids) == 0:
+            continue
+        days = int((end - start) / np.timedelta64(1, 'D')) + 1
+        var_ids = [column_list.index(item) for item in file_vars]
+
+        # the second pass scatters each chunk into a temporary [variable, id, day] array on disk, so memory stays
+        # flat however large the file is, and every series is then one contiguous slice of it
+        fd, cube_path = tempfile.mkstemp(dir=output_path, suffix='.npy')
+        os.close(fd)
+        try:
+            cube = np.lib.format.open_memmap(cube_path, mode='w+', dtype=np.float64,
+                                             shape=(len(file_vars), len(ids), days))
+            first = np.full(len(ids), days, dtype=np.int64)
+            last = np.full(len(ids), -1, dtype=np.int64)
+            for chunk_ids, dates, values in parse_output_file(file_path, column_list, file_vars):
+                positions, columns = np.searchsorted(ids, chunk_ids), (dates - start).astype(np.int64)
+                cube[:, positions, columns] = values
+                np.minimum.at(first, positions, columns)
+                np.maximum.at(last, positions, columns)
+
+            rows = ((watershed_id, object_id, var_id, (start + first[i]).item(),
+                     cube[v, i, first[i]:last[i] + 1].tolist())
+                    for i, object_id in enumerate(ids.tolist()) for v, var_id in enumerate(var_ids))
+            copy_rows(cur, table, ('watershed_id', id_column, 'var_id', 'start_date', 'vals'), rows)
+            conn.commit()
+            del cube
+        finally:
+            os.remove(cube_path)
+
+def write_output_cubes(output_path, sub_vars, rch_vars):
+    print('SWAT output files (cube storage)')
+    for file in os.listdir(output_path):
+        if file.endswith('.sub'):
+            file_type, column_list, file_vars = 'sub', sub_column_list, sub_vars
+        elif file.endswith('.rch'):
+            file_type, column_list, file_vars = 'rch', rch_column_list, rch_vars
+        else:
+            continue
+        print('writing ' + file + ' to output_' + file_type + '.npy')
+        file_path = os.path.join(output_path, file)
+
+        # first pass finds the reach/subbasin ids and the date range so the array can be allocated on disk
+        ids, start, end = output_extent(file_path, column_list)
+        if len(ids) == 0:
+            continue
+        days = int((end - start) / np.timedelta64(1, 'D')) + 1
+
+        cube = np.lib.format.open_memmap(os.path.join(output_path, 'output_' + file_type + '.npy'), mode='w+',
+                                         dtype=np.float32, shape=(len(file_vars), len(ids), days))
+        cube[:] = np.nan
+        for chunk_ids, dates, values in parse_output_file(file_path, column_list, file_vars):
+            cube[:, np.searchsorted(ids, chunk_ids), (dates - start).astype(np.int64)] = values
+        cube.flush()
+        del cube
+
+        with open(os.path.join(output_path, 'output_' + file_type + '.json'), 'w') as f:
+            json.dump({'start': str(start), 'vars': list(file_vars), 'ids': ids.tolist()}, f)
+
+def upload_cube_rollups(conn, output_path, watershed_name):
+    print('computing monthly and annual rollups from the output cubes')
+    cur = conn.cursor()
+    cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
+    records = cur.fetchall()
+    watershed_id = records[0][0]
+
+    for file_type, id_column in [('sub', 'sub_id'), ('rch', 'reach_id')]:
+        cube_path = os.path.join(output_path, 'output_' + file_type + '.npy')
+        if not os.path.exists(cube_path):
+            continue
+        with open(os.path.join(output_path, 'output_' + file_type + '.json')) as f:
+            meta = json.load(f)
+        cube = np.load(cube_path, mmap_mode='r')
+        days = np.datetime64(meta['start'], 'D') + np.arange(cube.shape[2])
+
+        for timestep, unit in [('Monthly', 'M'), ('Annual', 'Y')]:
+            # index of the first day of every period along the day axis
+            periods = days.astype('datetime64[' + unit + ']')
+            bounds = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+            for v, var_name in enumerate(meta['vars']):
+                # missing days are skipped like NULLs are in SQL aggregates
+                series = np.asarray(cube[v], dtype=np.float64)
+                valid = np.add.reduceat(~np.isnan(series), bounds, axis=1)
+                total = np.add.reduceat(np.nan_to_num(series), bounds, axis=1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    stats = [total, total / valid, np.fmin.reduceat(series, bounds, axis=1),
+                             np.fmax.reduceat(series, bounds, axis=1)]
+                rows = ((watershed_id, object_id, var_name, timestep, periods[bound].astype('datetime64[D]').item()) +
+                        tuple(float(stat[i, p]) for stat in stats)
+                        for i, object_id in enumerate(meta['ids']) for p, bound in enumerate(bounds) if valid[i, p] > 0)
+                copy_rows(cur, 'output_{0}_rollup'.format(file_type),
+                          ('watershed_id', id_column, 'var_name', 'timestep', 'period', 'val_sum', 'val_mean',
+                           'val_min', 'val_max'), rows)
+    conn.commit()
+
+def upload_rollups(conn, watershed_name, sub_vars, rch_vars):
+    print('computing monthly and annual rollups')
+    cur = conn.cursor()
+    cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
+    records = cur.fetchall()
+    watershed_id = records[0][0]
+
+    for file_type, id_column, column_list, file_vars in [('sub', 'sub_id', sub_column_list, sub_vars),
+                                                         ('rch', 'reach_id', rch_column_list, rch_vars)]:
+        if not any(file_vars):
+            continue
+        if output_storage == 'array':
+            # unnest each stored series back into (day, value) rows, naming variables by their var_id
+            var_names = ','.join("({0}, '{1}')".format(column_list.index(item), item) for item in file_vars)
+            daily = """(SELECT s.watershed_id, s.{0}, v.var_name, s.start_date + (t.i - 1)::int AS year_month_day, t.val
+                        FROM output_{1}_series s JOIN (VALUES {2}) AS v (var_id, var_name) ON v.var_id = s.var_id,
+                        unnest(s.vals) WITH ORDINALITY AS t (val, i) WHERE s.watershed_id = {3}) AS daily""".format(
+                id_column, file_type, var_names, watershed_id)
+        else:
+            daily = """(SELECT * FROM output_{0} WHERE watershed_id = {1}) AS daily""".format(file_type, watershed_id)
+
+        for timestep, trunc in [('Monthly', 'month'), ('Annual', 'year')]:
+            cur.execute("""INSERT INTO output_{0}_rollup (watershed_id, {1}, var_name, timestep, period, val_sum, val_mean, val_min, val_max)
+                        SELECT watershed_id, {1}, var_name, '{2}', date_trunc('{3}', year_month_day)::date,
+                               SUM(val), AVG(val), MIN(val), MAX(val)
+                        FROM {4} GROUP BY watershed_id, {1}, var_name, date_trunc('{3}', year_month_day)"""
+                        .format(file_type, id_column, timestep, trunc, daily))
+    conn.commit()
 
 def upload_shapefiles(geoserver, watershed_path):
     print('Watershed Data')
@@ -152,24 +286,20 @@ def upload_shapefiles(geoserver, watershed_path):
             path = os.path.join(watershed_path, file)
             storename = file.split('.')[0]
             print('uploading ' + storename + ' to geoserver')
-            headers = {'Content-type': 'application/zip', }
-            user = geoserver['user']
-            password = geoserver['password']
-            data = open(path, 'rb').read()
-
-            request_url = '{0}:{1}/geoserver/rest/workspaces/{2}/datastores/{3}/file.shp'.format(geoserver['url'],
-                                                                                                 geoserver['port'],
-                                                                                                 geoserver['workspace'],
-                                                                                                 storename)
+            publisher.publish(path, storename)
 
-            requests.put(request_url, verify=False, headers=headers, data=data, auth=(user, password))
+def subbasin_areas(output_path):
+    # area of each subbasin from the AREAkm2 column of output.sub; the first day lists every subbasin once
+    areas = {}
+    for file in os.listdir(output_path):
+        if file.endswith('.sub'):
+            ids, dates, values = next(parse_output_file(os.path.join(output_path, file), sub_column_list, ['AREAkm2']))
+            first_day = dates == dates[0]
+            areas.update(zip(ids[first_day].tolist(), values[0][first_day].tolist()))
+    return areas
 
-def upload_stream_connect(db, watershed_path, watershed_name):
+def upload_stream_connect(conn, watershed_path, output_path, watershed_name):
     print('uploading stream connectivity information to database')
-    conn = psycopg2.connect(
-        'dbname={0} user={1} password={2} host={3} port={4}'
-            .format(db['name'], db['user'], db['pass'], db['host'], db['port'])
-    )
     cur = conn.cursor()
 
     cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
@@ -183,15 +313,88 @@ def upload_stream_connect(db, watershed_path, watershed_name):
     dbf_path = os.path.join(watershed_path, watershed_name + '-reach.dbf')
 
     table = DBF(dbf_path, load=True)
-    for record in table:
-        stream_id = int(record['Subbasin'])
-        to_node = int(record['SubbasinR'])
+    stream_ids = [int(record['Subbasin']) for record in table]
+    to_nodes = [int(record['SubbasinR']) for record in table]
+    # subbasin areas let the app area-weight and total subbasin outputs over everything upstream of an outlet
+    areas = subbasin_areas(output_path)
+    copy_rows(cur, 'stream_connect', ('watershed_id', 'stream_id', 'to_node', 'area_km2'),
+              ((watershed_id, stream_id, to_node, areas.get(stream_id))
+               for stream_id, to_node in zip(stream_ids, to_nodes)))
+    conn.commit()
+
+def subbasin_histograms(raster_path, shp_zip_path, block_rows=1024):
+    # pixel count of every class in every subbasin. The subbasin polygons are rasterized onto the raster's grid one
+    # block of rows at a time so memory stays bounded however large the raster is
+    raster = gdal.Open(raster_path)
+    band = raster.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    gt = raster.GetGeoTransform()
+    layer = ogr.Open('/vsizip/' + shp_zip_path).GetLayer(0)
+
+    counts = {}
+    for row in range(0, raster.RasterYSize, block_rows):
+        rows = min(block_rows, raster.RasterYSize - row)
+        zones = gdal.GetDriverByName('MEM').Create('', raster.RasterXSize, rows, 1, gdal.GDT_Int32)
+        zones.SetGeoTransform((gt[0] + row * gt[2], gt[1], gt[2], gt[3] + row * gt[5], gt[4], gt[5]))
+        zones.SetProjection(raster.GetProjection())
+        gdal.RasterizeLayer(zones, [1], layer, options=['ATTRIBUTE=Subbasin'])
+
+        sub_ids = zones.GetRasterBand(1).ReadAsArray().ravel()
+        values = band.ReadAsArray(0, row, raster.RasterXSize, rows).ravel()
+        inside = sub_ids > 0
+        if nodata is not None:
+            inside &= values != nodata
+        pairs, pixels = np.unique(np.vstack((sub_ids[inside], values[inside].astype(np.int64))), axis=1,
+                                  return_counts=True)
+        for sub_id, value, n in zip(pairs[0].tolist(), pairs[1].tolist(), pixels.tolist()):
+            counts[(sub_id, value)] = counts.get((sub_id, value), 0) + n
+    return counts
+
+def upload_coverage_histograms(conn, data_path, watershed_name, raster_type):
+    print('computing ' + raster_type + ' histograms for each subbasin')
+    cur = conn.cursor()
+    cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
+    records = cur.fetchall()
+    watershed_id = records[0][0]
 
-        cur.execute("""INSERT INTO stream_connect (watershed_id, stream_id, to_node) VALUES ({0}, {1}, {2})""".format(
-            watershed_id, stream_id, to_node))
+    counts = subbasin_histograms(os.path.join(data_path, 'Land', raster_type + '.tif'),
+                                 os.path.join(data_path, 'Watershed', watershed_name + '-subbasin.zip'))
+    copy_rows(cur, 'coverage_histogram', ('watershed_id', 'raster_type', 'sub_id', 'value', 'pixels'),
+              ((watershed_id, raster_type, sub_id, value, n) for (sub_id, value), n in counts.items()))
+    conn.commit()
 
-        conn.commit()
-    conn.close()
+def normalize_land_rasters(land_path):
+    # rewrite every Land raster as a cloud-optimized GeoTIFF (internally tiled, compressed, with overviews) so clips,
+    # zonal statistics and WMS rendering read only the tiles they need
+    print('converting Land rasters to cloud-optimized GeoTIFFs')
+    for file in os.listdir(land_path):
+        if not file.endswith('.tif'):
+            continue
+        path = os.path.join(land_path, file)
+        src = gdal.Open(path)
+        if src.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') == 'COG':
+            continue
+        # lulc and soil are class codes, so their overviews must pick a class rather than average codes
+        resampling = 'AVERAGE' if 'dem' in file else 'NEAREST'
+        cog_path = path + '.cog.tmp'
+        if gdal.GetDriverByName('COG') is not None:
+            gdal.Translate(cog_path, src, format='COG',
+                           creationOptions=['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BLOCKSIZE=512',
+                                            'OVERVIEW_RESAMPLING=' + resampling, 'BIGTIFF=IF_SAFER'])
+        else:
+            # GDAL older than 3.1 has no COG driver: build the overviews on a tiled copy, then write them ahead of
+            # the full resolution tiles
+            tiled_path = path + '.tiled.tmp'
+            tiled = gdal.Translate(tiled_path, src, format='GTiff',
+                                   creationOptions=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER'])
+            tiled.BuildOverviews(resampling, [2, 4, 8, 16, 32, 64])
+            gdal.Translate(cog_path, tiled, format='GTiff',
+                           creationOptions=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE',
+                                            'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER'])
+            tiled = None
+            gdal.GetDriverByName('GTiff').Delete(tiled_path)
+        src = None
+        os.replace(cog_path, path)
 
 def upload_tiffiles(geoserver, land_path, watershed_name):
     print('Land Data')
@@ -200,81 +403,66 @@ def upload_tiffiles(geoserver, land_path, watershed_name):
             path = os.path.join(land_path, file)
             storename = watershed_name + '-' + file.split('.')[0]
             print('uploading ' + storename + ' to geoserver')
-            headers = {'Content-type': 'image/tiff', }
-            user = geoserver['user']
-            password = geoserver['password']
-            data = open(path, 'rb').read()
-
-            request_url = '{0}:{1}/geoserver/rest/workspaces/{2}/coveragestores/{3}/file.geotiff'.format(geoserver['url'],
-                                                                                                         geoserver['port'],
-                                                                                                         geoserver['workspace'],
-                                                                                                         storename)
+            publisher.publish(path, storename)
 
-            requests.put(request_url, verify=False, headers=headers, data=data, auth=(user, password))
-
-def upload_lulc_key(db, land_path, watershed_name):
+def upload_lulc_key(conn, land_path, watershed_name):
     print('uploading lulc_key to database')
-    conn = psycopg2.connect(
-        'dbname={0} user={1} password={2} host={3} port={4}'
-            .format(db['name'], db['user'], db['pass'], db['host'], db['port'])
-    )
     cur = conn.cursor()
     cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
     records = cur.fetchall()
     watershed_id = records[0][0]
 
     lulc_key_path = os.path.join(land_path, 'lulc_key.txt')
-    f = open(lulc_key_path)
-    for line in f:
-        if 'Value' not in line and line != '\n':
-            line = line.strip()
-            line=line.strip(' ')
-            columns = line.split(',')
-            value = int(columns[0])
-            lulc = columns[1]
-            lulc_class = columns[2]
-            lulc_subclass = columns[3]
-            class_color = columns[4]
-            subclass_color = columns[5]
-            cur.execute("""INSERT INTO lulc (watershed_id,value,lulc,lulc_class,lulc_subclass,class_color,subclass_color) 
-                        VALUES ({0}, {1}, '{2}', '{3}', '{4}', '{5}', '{6}')"""
-                        .format(watershed_id, value, lulc, lulc_class, lulc_subclass, class_color, subclass_color))
-
-        conn.commit()
+    rows = []
+    with open(lulc_key_path) as f:
+        for line in f:
+            if 'Value' not in line and line.strip() != '':
+                columns = line.strip().split(',')
+                # value, lulc, lulc_class, lulc_subclass, class_color, subclass_color
+                rows.append([watershed_id, int(columns[0])] + columns[1:6])
+    copy_rows(cur, 'lulc', ('watershed_id', 'value', 'lulc', 'lulc_class', 'lulc_subclass', 'class_color',
+                            'subclass_color'), rows)
+    conn.commit()
 
-def upload_soil_key(db, land_path, watershed_name):
+def upload_soil_key(conn, land_path, watershed_name):
     print('uploading soil_key to database')
-    conn = psycopg2.connect(
-        'dbname={0} user={1} password={2} host={3} port={4}'
-            .format(db['name'], db['user'], db['pass'], db['host'], db['port'])
-    )
     cur = conn.cursor()
     cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
     records = cur.fetchall()
     watershed_id = records[0][0]
 
     soil_key_path = os.path.join(land_path, 'soil_key.txt')
-    f = open(soil_key_path)
-    for line in f:
-        if 'Value' not in line:
-            line = line.strip()
-            line=line.strip(' ')
-            columns = line.split(',')
-            value = int(columns[0])
-            soil_class = columns[1]
-            class_color = columns[2]
-            cur.execute("""INSERT INTO soil (watershed_id, value, soil_class, class_color)
-                        VALUES ({0}, {1}, '{2}', '{3}')"""
-                        .format(watershed_id, value, soil_class, class_color))
+    rows = []
+    with open(soil_key_path) as f:
+        for line in f:
+            if 'Value' not in line and line.strip() != '':
+                columns = line.strip().split(',')
+                # value, soil_class, class_color
+                rows.append([watershed_id, int(columns[0])] + columns[1:3])
+    copy_rows(cur, 'soil', ('watershed_id', 'value', 'soil_class', 'class_color'), rows)
+    conn.commit()
 
-        conn.commit()
+def output_date_range(cur, file_type, watershed_id):
+    if output_storage == 'cube':
+        with open(os.path.join(data_path, 'Outputs', 'output_' + file_type + '.json')) as f:
+            meta = json.load(f)
+        cube = np.load(os.path.join(data_path, 'Outputs', 'output_' + file_type + '.npy'), mmap_mode='r')
+        start = datetime.datetime.strptime(meta['start'], '%Y-%m-%d').date()
+        return start, start + datetime.timedelta(days=cube.shape[2] - 1)
+    if output_storage == 'array':
+        cur.execute(
+            """SELECT MIN(start_date), MAX(start_date + array_length(vals, 1) - 1) FROM output_{0}_series
+               WHERE watershed_id={1}""".format(file_type, watershed_id)
+        )
+    else:
+        cur.execute(
+            """SELECT MIN(year_month_day), MAX(year_month_day) FROM output_{0} WHERE watershed_id={1}"""
+                .format(file_type, watershed_id)
+        )
+    return cur.fetchall()[0]
 
-def watershed_info(watershed_name, available_files, sub_vars, rch_vars):
+def watershed_info(conn, watershed_name, available_files, sub_vars, rch_vars):
     print('Compiling metadata for the new watershed')
-    conn = psycopg2.connect(
-        'dbname={0} user={1} password={2} host={3} port={4}'
-            .format(db['name'], db['user'], db['pass'], db['host'], db['port'])
-    )
     cur = conn.cursor()
     cur.execute("""SELECT * FROM watershed WHERE name = '{0}'""".format(watershed_name))
     records = cur.fetchall()
@@ -289,30 +477,14 @@ def watershed_info(watershed_name, available_files, sub_vars, rch_vars):
 
     if 'output.sub' in available_outputs:
         sub = 'Yes'
-        cur.execute(
-            """SELECT MIN(year_month_day) FROM output_sub WHERE watershed_id={0}""".format(watershed_id)
-        )
-        sub_start = cur.fetchall()[0][0]
-
-        cur.execute(
-            """SELECT MAX(year_month_day) FROM output_sub WHERE watershed_id={0}""".format(watershed_id)
-        )
-        sub_end = cur.fetchall()[0][0]
+        sub_start, sub_end = output_date_range(cur, 'sub', watershed_id)
     else:
         sub = 'No'
         sub_start = datetime.date(2000, 1, 1)
         sub_end = datetime.date(2000, 1, 1)
     if 'output.rch' in available_outputs:
         rch = 'Yes'
-        cur.execute(
-            """SELECT MIN(year_month_day) FROM output_rch WHERE watershed_id={0}""".format(watershed_id)
-        )
-        rch_start = cur.fetchall()[0][0]
-
-        cur.execute(
-            """SELECT MAX(year_month_day) FROM output_rch WHERE watershed_id={0}""".format(watershed_id)
-        )
-        rch_end = cur.fetchall()[0][0]
+        rch_start, rch_end = output_date_range(cur, 'rch', watershed_id)
     else:
         rch = 'No'
         rch_start = datetime.date(2000, 1, 1)
@@ -342,19 +514,40 @@ def watershed_info(watershed_name, available_files, sub_vars, rch_vars):
         sub_end, sub_vars, lulc, soil, stations, sub, rch, nasaaccess)
                 )
     conn.commit()
-    conn.close()
+
+def bump_data_version(conn, watershed_name):
+    # invalidates results the app has cached for this watershed
+    cur = conn.cursor()
+    cur.execute("""UPDATE watershed SET data_version = data_version + 1 WHERE name = '{0}'""".format(watershed_name))
+    conn.commit()
 
 #Check watershed availability and run data upload functions
-if new_watershed(db, watershed_name) == 0:
+conn = connect(db)
+if new_watershed(conn, watershed_name) == 0:
     available_files = check_available_files(watershed_name, data_path)
     if available_files != 1:
-        upload_swat_outputs(db, os.path.join(data_path, 'Outputs'), watershed_name, sub_vars, rch_vars)
+        create_partitions(conn, watershed_name)
+        if output_storage == 'cube':
+            write_output_cubes(os.path.join(data_path, 'Outputs'), sub_vars, rch_vars)
+            upload_cube_rollups(conn, os.path.join(data_path, 'Outputs'), watershed_name)
+        else:
+            if output_storage == 'array':
+                upload_swat_output_series(conn, os.path.join(data_path, 'Outputs'), watershed_name, sub_vars, rch_vars)
+            else:
+                upload_swat_outputs(conn, os.path.join(data_path, 'Outputs'), watershed_name, sub_vars, rch_vars)
+            upload_rollups(conn, watershed_name, sub_vars, rch_vars)
         upload_shapefiles(geoserver, os.path.join(data_path, 'Watershed'))
-        upload_stream_connect(db, os.path.join(data_path, 'Watershed'), watershed_name)
+        upload_stream_connect(conn, os.path.join(data_path, 'Watershed'), os.path.join(data_path, 'Outputs'), watershed_name)
+        normalize_land_rasters(os.path.join(data_path, 'Land'))
         upload_tiffiles(geoserver, os.path.join(data_path, 'Land'), watershed_name)
+        for raster_type in ['lulc', 'soil']:
+            if raster_type + '.tif' in available_files['Land']:
+                upload_coverage_histograms(conn, data_path, watershed_name, raster_type)
         if 'lulc_key.txt' in available_files['Land']:
-            upload_lulc_key(db, os.path.join(data_path, 'Land'), watershed_name)
+            upload_lulc_key(conn, os.path.join(data_path, 'Land'), watershed_name)
         if 'soil_key.txt' in available_files['Land']:
-            upload_soil_key(db, os.path.join(data_path, 'Land'), watershed_name)
-        watershed_info(watershed_name, available_files, sub_vars, rch_vars)
+            upload_soil_key(conn, os.path.join(data_path, 'Land'), watershed_name)
+        watershed_info(conn, watershed_name, available_files, sub_vars, rch_vars)
+        bump_data_version(conn, watershed_name)
     print('SUCCESS: Upload Complete!')
+conn.close()